@@ -0,0 +1,614 @@
+"""
+Benchmarks extract_tagged_rois.py without an OMERO server.
+
+The script's export runs end to end against in-process stand-ins for the
+BlitzGateway, the query and ROI services and the rendering engine, on
+synthetic images and shapes. omero-py must be installed (for the model
+classes and rtypes) but no server is needed. Reports the time spent in each
+stage and the throughput, after checking the index and files of each run
+against what the stand-ins hold.
+
+Example:
+    python benchmarks/benchmark_extract_tagged_rois.py --images 4 \
+        --shapes 2000 --vertices 64 --format PNG --workers 4
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from collections import namedtuple
+from io import BytesIO
+from math import ceil, floor
+
+import numpy
+from PIL import Image
+
+from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
+    PointI, ImageI, PixelsI, PixelsTypeI, ChannelI, LogicalChannelI
+from omero.rtypes import rdouble, rint, rlong, rstring, unwrap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "scripts"))
+import extract_tagged_rois as etr
+
+SHAPE_TYPES = ("rectangle", "ellipse", "polygon", "polyline", "line", "point")
+# same fields as omero.romio ShapeStats
+FakeShapeStats = namedtuple("FakeShapeStats", ["shapeId", "pointsCount",
+                                               "min", "max", "sum", "mean",
+                                               "stdDev"])
+
+
+def make_shape(rng, shape_type, shape_id, size_x, size_y, size_z, size_t,
+               vertices):
+    """Makes a shape of the given type at a random place on the image."""
+    w = rng.uniform(8, min(256, size_x / 4))
+    h = rng.uniform(8, min(256, size_y / 4))
+    x = rng.uniform(0, size_x - w)
+    y = rng.uniform(0, size_y - h)
+    if shape_type == "rectangle":
+        shape = RectangleI()
+        shape.setX(rdouble(x))
+        shape.setY(rdouble(y))
+        shape.setWidth(rdouble(w))
+        shape.setHeight(rdouble(h))
+    elif shape_type == "ellipse":
+        shape = EllipseI()
+        shape.setX(rdouble(x + w / 2))
+        shape.setY(rdouble(y + h / 2))
+        shape.setRadiusX(rdouble(w / 2))
+        shape.setRadiusY(rdouble(h / 2))
+    elif shape_type in ("polygon", "polyline"):
+        shape = PolygonI() if shape_type == "polygon" else PolylineI()
+        angles = numpy.linspace(0, 2 * numpy.pi, vertices, endpoint=False)
+        radii = numpy.array([rng.uniform(0.5, 1) for _ in angles])
+        xs = x + w / 2 * (1 + radii * numpy.cos(angles))
+        ys = y + h / 2 * (1 + radii * numpy.sin(angles))
+        shape.setPoints(rstring(" ".join("%.2f,%.2f" % p
+                                         for p in zip(xs, ys))))
+    elif shape_type == "line":
+        shape = LineI()
+        shape.setX1(rdouble(x))
+        shape.setY1(rdouble(y))
+        shape.setX2(rdouble(x + w))
+        shape.setY2(rdouble(y + h))
+    else:
+        shape = PointI()
+        shape.setX(rdouble(x))
+        shape.setY(rdouble(y))
+    shape.setId(rlong(shape_id))
+    shape.setTheZ(rint(rng.randrange(size_z)))
+    shape.setTheT(rint(rng.randrange(size_t)))
+    return shape
+
+
+class FakeChannel(object):
+
+    def __init__(self, index, pixels_type_max):
+        self.index = index
+        self.active = True
+        self.window = (0, pixels_type_max)
+
+    def getLabel(self):
+        return "ch%d" % self.index
+
+    def isActive(self):
+        return self.active
+
+    def getWindowStart(self):
+        return self.window[0]
+
+    def getWindowEnd(self):
+        return self.window[1]
+
+    def getColor(self):
+        return self
+
+    def getHtml(self):
+        return ("FF0000", "00FF00", "0000FF")[self.index % 3]
+
+
+class FakeRenderingEngine(object):
+
+    def requiresPixelsPyramid(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeRawPixelsStore(object):
+    """Reads tiles of the images' planes, one channel per RGB component."""
+
+    def __init__(self, server):
+        self.server = server
+        self.image = None
+
+    def setPixelsId(self, pixels_id, bypass_original_file):
+        self.image = self.server.images[pixels_id]
+
+    def getResolutionDescriptions(self):
+        description = namedtuple("ResolutionDescription", ["sizeX", "sizeY"])
+        return [description(self.image.size_x, self.image.size_y)]
+
+    def setResolutionLevel(self, level):
+        pass
+
+    def getTileSize(self):
+        return [256, 256]
+
+    def getTile(self, z, c, t, x, y, width, height):
+        self.server.wait()
+        return self.image.plane[y:y + height, x:x + width, c % 3].tobytes()
+
+    def close(self):
+        pass
+
+
+class FakeImage(object):
+    """
+    Stands in for an ImageWrapper. Renders by cropping and encoding a
+    random RGB plane, which stands in for the server's rendering time.
+    """
+
+    def __init__(self, image_id, name, size_x, size_y, size_c, size_z,
+                 size_t, plane):
+        self.id = image_id
+        self.pixels_id = image_id
+        self.name = name
+        self.size_x = size_x
+        self.size_y = size_y
+        self.size_c = size_c
+        self.size_z = size_z
+        self.size_t = size_t
+        self.plane = plane
+        self.channels = [FakeChannel(c, 255) for c in range(size_c)]
+        self.greyscale = False
+        self.projection = "normal"
+        self._re = None
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getDefaultZ(self):
+        return 0
+
+    def getDefaultT(self):
+        return 0
+
+    def getPixelsId(self):
+        return self.pixels_id
+
+    def getChannels(self):
+        return self.channels
+
+    def make_pixels(self):
+        """
+        Makes the loaded Pixels, as returned by the query in
+        load_image_meta(). There is no pixel size, so lengths and areas
+        are in pixels.
+        """
+        image = ImageI(self.id, False)
+        image.setName(rstring(self.name))
+        pixels_type = PixelsTypeI()
+        pixels_type.setValue(rstring("uint8"))
+        pixels = PixelsI(self.pixels_id, True)
+        pixels.setImage(image)
+        pixels.setPixelsType(pixels_type)
+        pixels.setSizeX(rint(self.size_x))
+        pixels.setSizeY(rint(self.size_y))
+        pixels.setSizeZ(rint(self.size_z))
+        pixels.setSizeC(rint(self.size_c))
+        pixels.setSizeT(rint(self.size_t))
+        for ch in self.channels:
+            logical_channel = LogicalChannelI()
+            logical_channel.setName(rstring(ch.getLabel()))
+            channel = ChannelI()
+            channel.setLogicalChannel(logical_channel)
+            pixels.addChannel(channel)
+        return pixels
+
+    def setActiveChannels(self, channels):
+        for ch in self.channels:
+            ch.active = ch.index + 1 in channels
+
+    def setGreyscaleRenderingModel(self):
+        self.greyscale = True
+
+    def setColorRenderingModel(self):
+        self.greyscale = False
+
+    def isGreyscaleRenderingModel(self):
+        return self.greyscale
+
+    def getProjection(self):
+        return self.projection
+
+    def setProjection(self, projection):
+        self.projection = projection
+
+    def _prepareRenderingEngine(self):
+        self._re = FakeRenderingEngine()
+        return True
+
+    def _prepareRE(self):
+        return FakeRenderingEngine()
+
+    def _encode(self, data):
+        buf = BytesIO()
+        Image.fromarray(data).save(buf, "JPEG", quality=90)
+        return buf.getvalue()
+
+    def renderJpeg(self, z, t):
+        return self._encode(self.plane[:self.size_y, :self.size_x])
+
+    def renderJpegRegion(self, z, t, x, y, width, height, level=None):
+        return self._encode(self.plane[y:y + height, x:x + width])
+
+
+class FakeQueryService(object):
+    """Answers the queries made by extract_tagged_rois.py."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def projection(self, query, params, ctx=None):
+        self.server.wait()
+        if "from RenderingDef" in query:
+            # no saved rendering settings, so Z and T default to 0
+            return []
+        image_ids = set(unwrap(params.map["ids"]))
+        offset = params.theFilter.offset.val
+        limit = params.theFilter.limit.val
+        rows = [row for row in self.server.tagged_rows
+                if row[0] in image_ids][offset:offset + limit]
+        return [[rlong(image_id), rlong(roi_id), rlong(shape_id),
+                 rlong(version), rstring(text)]
+                for image_id, roi_id, shape_id, version, text in rows]
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self.server.wait()
+        if "from Pixels" in query:
+            return [self.server.images[image_id].make_pixels()
+                    for image_id in unwrap(params.map["ids"])]
+        return [self.server.shapes[shape_id]
+                for shape_id in unwrap(params.map["ids"])]
+
+
+class FakeRoiService(object):
+    """Returns made up stats, the same for every call."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def getShapeStatsRestricted(self, shape_ids, z, t, channels):
+        self.server.wait()
+        n = len(channels)
+        return [FakeShapeStats(shape_id, [100] * n, [0.0] * n, [255.0] * n,
+                               [12800.0] * n, [128.0] * n, [32.0] * n)
+                for shape_id in shape_ids]
+
+
+class FakeConn(object):
+    """Stands in for a BlitzGateway connected to a server."""
+
+    def __init__(self, server):
+        self.server = server
+        self.query_service = FakeQueryService(server)
+        self.roi_service = FakeRoiService(server)
+
+    def getUserId(self):
+        return 1
+
+    def getQueryService(self):
+        return self.query_service
+
+    def getRoiService(self):
+        return self.roi_service
+
+    def createRawPixelsStore(self):
+        return FakeRawPixelsStore(self.server)
+
+    def createFileAnnfromLocalFile(self, path, mimetype=None):
+        return None
+
+    def close(self, hard=True):
+        pass
+
+
+class FakeServer(object):
+    """
+    Synthetic images and tagged shapes, and the latency of each service
+    call.
+    """
+
+    def __init__(self, args):
+        rng = random.Random(args.seed)
+        self.latency = args.latency_ms / 1000.0
+        self.images = {}
+        self.shapes = {}
+        # (image_id, roi_id, shape_id, version, text), as returned by the
+        # query in find_tagged_shapes()
+        self.tagged_rows = []
+        tags = ["tag%d" % i for i in range(args.tags)]
+        plane = numpy.random.RandomState(args.seed).randint(
+            0, 256, (args.size, args.size, 3)).astype(numpy.uint8)
+        shape_id = 0
+        for image_id in range(1, args.images + 1):
+            self.images[image_id] = FakeImage(
+                image_id, "image%d.tif" % image_id, args.size, args.size,
+                args.channels, args.planes, 1, plane)
+            for i in range(args.shapes):
+                shape_id += 1
+                shape_type = SHAPE_TYPES[i % len(SHAPE_TYPES)]
+                shape = make_shape(rng, shape_type, shape_id, args.size,
+                                   args.size, args.planes, 1, args.vertices)
+                text = " ".join("#%s" % tag for tag in
+                                rng.sample(tags, args.tags_per_shape))
+                shape.setTextValue(rstring(text))
+                self.shapes[shape_id] = shape
+                self.tagged_rows.append((image_id, shape_id, shape_id, 1,
+                                         text))
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def get_script_params(args):
+    return {
+        "Data_Type": "Image",
+        "IDs": [],
+        "Export_Individual_Channels": args.split_channels,
+        "Individual_Channels_Grey": False,
+        "Export_Merged_Image": True,
+        "Crop_To_ROIs": not args.planes_only,
+        "Raw_Pixels": args.raw_pixels,
+        "Mask_Raw_Pixels": True,
+        "Format": args.format,
+        "Render_To_Archive": not args.to_disk,
+        "Folder_Name": "Benchmark_Export",
+        "Tag_Delimiter": "#",
+        "Channels": list(range(1, args.channels + 1)),
+        "Workers": args.workers,
+        "Stats_Batch_Size": etr.STATS_BATCH_SIZE,
+    }
+
+
+def run_export(server, script_params):
+    """
+    Runs an export like run_script() does, in the current folder.
+
+    @return:            Tuple of (timings report, rows written, zip size)
+    """
+    conn = FakeConn(server)
+    images = [server.images[i] for i in sorted(server.images)]
+    # fresh state for each run
+    etr.timings = etr.Timings()
+    etr.shape_geometry_cache.clear()
+    folder_name = script_params["Folder_Name"]
+    export_file = "%s.zip" % folder_name
+    etr.archive = etr.ZipPackager(export_file,
+                                  script_params["Render_To_Archive"])
+    try:
+        tables, tag_index, _, _ = etr.export_images_of_tagged_rois(
+            conn, script_params, images)
+        index_path = os.path.join(folder_name, etr.INDEX_FILE_NAME)
+        _, row_count = etr.write_csv(conn, tables, None, index_path)
+        etr.archive_file(index_path)
+        tag_index_path = os.path.join(folder_name, "tag_index.csv")
+        etr.write_tag_index(tag_index, tag_index_path)
+        etr.archive_file(tag_index_path)
+    finally:
+        etr.archive.close()
+        etr.archive = None
+    return etr.timings.report(), row_count, os.path.getsize(export_file)
+
+
+def get_shape_region(shape, size_x, size_y):
+    """
+    The pixels a shape's file should hold: its bounding box rounded out and
+    clipped to the image. None for shapes without one.
+    """
+    if isinstance(shape, RectangleI):
+        x0, y0 = shape.getX().val, shape.getY().val
+        x1 = x0 + shape.getWidth().val
+        y1 = y0 + shape.getHeight().val
+    elif isinstance(shape, EllipseI):
+        x0 = shape.getX().val - shape.getRadiusX().val
+        y0 = shape.getY().val - shape.getRadiusY().val
+        x1 = shape.getX().val + shape.getRadiusX().val
+        y1 = shape.getY().val + shape.getRadiusY().val
+    elif isinstance(shape, PolygonI) and not isinstance(shape, PolylineI):
+        points = numpy.array([[float(v) for v in p.split(",")]
+                              for p in shape.getPoints().val.split()])
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    else:
+        return None
+    x0, y0 = max(0, int(floor(x0))), max(0, int(floor(y0)))
+    x1, y1 = min(size_x, int(ceil(x1))), min(size_y, int(ceil(y1)))
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def check_export(server, script_params, export_file):
+    """
+    Checks an export against the stand-ins, independently of how
+    extract_tagged_rois.py works it out: the index has a row per shape, tag
+    and channel in the order the shapes were found, the stats are the
+    server's or those of the pixels, and each cropped shape has its files
+    with the right pixels. Raises AssertionError on the first mismatch.
+
+    @return:            Tuple of (rows checked, files checked)
+    """
+    def check(condition, message, *args):
+        if not condition:
+            raise AssertionError(message % args)
+
+    channels = [c - 1 for c in script_params["Channels"]]
+    raw_pixels = script_params["Raw_Pixels"]
+    crop = script_params["Crop_To_ROIs"] and \
+        script_params["Format"] != 'OME-TIFF'
+    with zipfile.ZipFile(export_file) as z:
+        names = z.namelist()
+        with z.open(etr.INDEX_FILE_NAME) as f:
+            rows = list(csv.DictReader(io.TextIOWrapper(f, encoding='utf8')))
+        expected = []
+        for image_id, roi_id, shape_id, _, text in server.tagged_rows:
+            shape = server.shapes[shape_id]
+            for tag in re.findall(r'#(\S+)', text):
+                for c in channels:
+                    expected.append((str(image_id), str(roi_id),
+                                     str(shape_id), tag,
+                                     str(shape.getTheZ().val + 1),
+                                     str(shape.getTheT().val + 1),
+                                     "ch%d" % c))
+        check(len(rows) == len(expected), "%d rows, expected %d",
+              len(rows), len(expected))
+        file_count = 0
+        for row, key in zip(rows, expected):
+            found = (row["image_id"], row["roi_id"], row["shape_id"],
+                     row["tag"], row["z"], row["t"], row["channel"])
+            check(found == key, "row %s, expected %s", found, key)
+            stats = [float(row[name]) for name in
+                     ("points", "min", "max", "sum", "mean", "std_dev")]
+            if row["stats_source"] == "server":
+                check(stats == [100, 0, 255, 12800, 128, 32],
+                      "shape %s has stats %s, not the server's",
+                      row["shape_id"], stats)
+            else:
+                check(row["stats_source"] == "pixels" and raw_pixels,
+                      "shape %s has stats from %s", row["shape_id"],
+                      row["stats_source"])
+                check(stats[0] > 0 and stats[1] <= stats[4] <= stats[2],
+                      "shape %s has stats %s", row["shape_id"], stats)
+        for image_id, roi_id, shape_id, _, _ in server.tagged_rows:
+            image = server.images[image_id]
+            shape = server.shapes[shape_id]
+            region = get_shape_region(shape, image.size_x, image.size_y)
+            if not crop or region is None:
+                continue
+            prefix = "roi%s_shape%s_" % (roi_id, shape_id)
+            files = [name for name in names if name.startswith(prefix)]
+            check(files, "no files for shape %s", shape_id)
+            x, y, width, height = region
+            for name in files:
+                file_count += 1
+                if name.endswith(".npy"):
+                    data = numpy.load(io.BytesIO(z.read(name)))
+                    check(data.shape == (len(channels), height, width),
+                          "%s is %s, expected %s", name, data.shape,
+                          (len(channels), height, width))
+                    pixels = numpy.stack([
+                        image.plane[y:y + height, x:x + width, c % 3]
+                        for c in channels])
+                    # pixels outside the shape are masked to 0
+                    check(((data == pixels) | (data == 0)).all(),
+                          "%s doesn't hold the shape's pixels", name)
+                elif not raw_pixels:
+                    size = Image.open(io.BytesIO(z.read(name))).size
+                    check(size == (width, height), "%s is %s, expected %s",
+                          name, size, (width, height))
+    return len(rows), file_count
+
+
+def print_report(report, shape_count, row_count, zip_size):
+    duration = report["duration"]
+    print("%d shapes, %d rows, %.1f MB zip in %.2f s"
+          % (shape_count, row_count, zip_size / 1e6, duration))
+    print("  %.0f shapes/s, %.0f rows/s, %.1f MB/s"
+          % (shape_count / duration, row_count / duration,
+             zip_size / 1e6 / duration))
+    print("  %-20s %8s %10s %10s" % ("stage", "calls", "seconds", "ms/call"))
+    for name, stage in sorted(report["stages"].items(),
+                              key=lambda item: -item[1]["seconds"]):
+        print("  %-20s %8d %10.3f %10.3f"
+              % (name, stage["calls"], stage["seconds"],
+                 1000.0 * stage["seconds"] / stage["calls"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=2)
+    parser.add_argument("--shapes", type=int, default=500,
+                        help="Tagged shapes per image")
+    parser.add_argument("--tags", type=int, default=10,
+                        help="Number of different tags")
+    parser.add_argument("--tags-per-shape", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--planes", type=int, default=1,
+                        help="Z planes per image")
+    parser.add_argument("--vertices", type=int, default=32,
+                        help="Points per polygon and polyline")
+    parser.add_argument("--size", type=int, default=2048,
+                        help="Width and height of the images")
+    parser.add_argument("--format", default="JPEG",
+                        choices=sorted(etr.IMAGE_FORMATS))
+    parser.add_argument("--split-channels", action="store_true",
+                        help="Also export each channel")
+    parser.add_argument("--planes-only", action="store_true",
+                        help="Export whole planes instead of cropped ROIs")
+    parser.add_argument("--raw-pixels", action="store_true",
+                        help="Save raw pixel values instead of rendering")
+    parser.add_argument("--to-disk", action="store_true",
+                        help="Save images to disk before zipping them")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="Added to every query and ROI service call")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the reports to this file")
+    parser.add_argument("--no-check", action="store_true",
+                        help="Don't check the export against the stand-ins")
+    args = parser.parse_args(argv)
+
+    # the caches would make repeats faster than the first run
+    etr.stats_cache = None
+    etr.render_cache = None
+    etr.export_log.level = etr.INFO
+    # worker threads share the fake connection
+    etr.open_worker_conn = lambda conn: conn
+
+    server = FakeServer(args)
+    shape_count = len(server.shapes)
+    script_params = get_script_params(args)
+    reports = []
+    work_dir = tempfile.mkdtemp(prefix="benchmark_extract_tagged_rois")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        for i in range(args.repeat):
+            shutil.rmtree(script_params["Folder_Name"], ignore_errors=True)
+            report, row_count, zip_size = run_export(server, script_params)
+            print("Run %d of %d:" % (i + 1, args.repeat))
+            if not args.no_check:
+                checked = check_export(
+                    server, script_params,
+                    "%s.zip" % script_params["Folder_Name"])
+                print("  checked %d rows and %d files" % checked)
+            print_report(report, shape_count, row_count, zip_size)
+            report["shapes"] = shape_count
+            report["rows"] = row_count
+            report["zip_bytes"] = zip_size
+            reports.append(report)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"args": vars(args), "runs": reports}, f, indent=1,
+                      sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
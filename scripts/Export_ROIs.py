@@ -28,10 +28,26 @@ from omero.rtypes import rlong, rint, rstring, robject, unwrap
 from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
     MaskI, LabelI, PointI
 from math import sqrt, pi
+from collections import namedtuple
+import os
 import re
+import sqlite3
+import tempfile
+import threading
+import time
 
 DEFAULT_FILE_NAME = "Batch_ROI_Export.csv"
+STATS_BATCH_SIZE = 500
+# stats kept in the local stats cache, off unless Stats_Cache_Size is set
+STATS_CACHE_SIZE = 0
+STATS_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                "export_rois_stats.sqlite")
 INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
+# stats from the ShapeStatsCache, with the same fields as ShapeStats
+CachedStats = namedtuple("CachedStats", ["shapeId", "pointsCount", "min",
+                                         "max", "sum", "mean", "stdDev"])
+# ShapeStatsCache consulted by get_shape_stats(), if any
+stats_cache = None
 
 
 def log(data):
@@ -39,6 +55,172 @@ def log(data):
     print(data)
 
 
+class ShapeStatsCache(object):
+    """
+    Keeps shape stats in a local SQLite database so that shapes measured
+    in an earlier run aren't measured again by the server.
+
+    Stats are keyed by pixels ID, shape ID, shape version (the ID of the
+    event that last updated the shape), Z, T and channel, so editing a
+    shape makes its old stats unreachable. Once there are more than
+    max_entries rows, the least recently used are evicted.
+
+    The database may be locked by another run, so reads and writes that
+    fail are logged and the stats measured by the server instead.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "create table if not exists stats (pixels_id integer, "
+            "shape_id integer, version integer, z integer, t integer, "
+            "c integer, points integer, min real, max real, sum real, "
+            "mean real, std_dev real, last_used real, primary key "
+            "(pixels_id, shape_id, version, z, t, c))")
+        self.db.execute("create index if not exists stats_last_used "
+                        "on stats (last_used)")
+        self.entries = self.db.execute(
+            "select count(*) from stats").fetchone()[0]
+        # last used times of cache hits, written with the next put
+        self.used = []
+
+    def get(self, pixels_id, z, t, ch_indexes, versions):
+        """
+        Looks up the stats of the shapes on a plane. Shapes are only found
+        if all of the channels are cached.
+
+        @param versions:    Dict of {shapeId: version} of the shapes to look
+                            up
+        @return:            Dict of {(shapeId, z, t): CachedStats}
+        """
+        rows = {}
+        with self.lock:
+            try:
+                cursor = self.db.execute(
+                    "select shape_id, version, c, points, min, max, sum, "
+                    "mean, std_dev from stats where pixels_id = ? and z = ? "
+                    "and t = ?", (pixels_id, z, t))
+                for row in cursor:
+                    shape_id, version, c = row[:3]
+                    if versions.get(shape_id) == version:
+                        rows[(shape_id, c)] = row[3:]
+            except sqlite3.Error as e:
+                log("Can't read stats cache: %s" % e)
+                return {}
+            shape_stats = {}
+            now = time.time()
+            for shape_id, version in versions.items():
+                values = [rows.get((shape_id, c)) for c in ch_indexes]
+                if version is None or None in values:
+                    continue
+                # one list per stat, with a value per channel like ShapeStats
+                shape_stats[(shape_id, z, t)] = CachedStats(
+                    shape_id, *[list(v) for v in zip(*values)])
+                self.used.append((now, pixels_id, shape_id, version, z, t))
+        return shape_stats
+
+    def put(self, pixels_id, z, t, ch_indexes, versions, stats):
+        """Stores ShapeStats from the ROI service, see get()."""
+        now = time.time()
+        rows = []
+        for shape_stat in stats:
+            version = versions.get(shape_stat.shapeId)
+            if version is None:
+                continue
+            for i, c in enumerate(ch_indexes):
+                rows.append((pixels_id, shape_stat.shapeId, version, z, t, c,
+                             shape_stat.pointsCount[i], shape_stat.min[i],
+                             shape_stat.max[i], shape_stat.sum[i],
+                             shape_stat.mean[i], shape_stat.stdDev[i], now))
+        with self.lock:
+            try:
+                self._write_used()
+                self.db.executemany(
+                    "insert or replace into stats values "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.commit()
+                self.entries += len(rows)
+                if self.entries > self.max_entries:
+                    self._evict()
+            except sqlite3.Error as e:
+                log("Can't write stats cache: %s" % e)
+                self.db.rollback()
+
+    def _write_used(self):
+        used, self.used = self.used, []
+        self.db.executemany(
+            "update stats set last_used = ? where pixels_id = ? and "
+            "shape_id = ? and version = ? and z = ? and t = ?", used)
+
+    def _evict(self):
+        self.entries = self.db.execute(
+            "select count(*) from stats").fetchone()[0]
+        # evict a tenth more than needed so this doesn't run on every put
+        excess = self.entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            self.db.execute(
+                "delete from stats where rowid in (select rowid from stats "
+                "order by last_used limit ?)", (excess,))
+            self.db.commit()
+            self.entries -= excess
+
+    def close(self):
+        with self.lock:
+            try:
+                self._write_used()
+                self.db.commit()
+            except sqlite3.Error as e:
+                log("Can't write stats cache: %s" % e)
+            self.db.close()
+
+
+def open_stats_cache(script_params):
+    """
+    Opens the stats cache, or returns None if it is turned off or can't be
+    opened.
+    """
+    size = script_params.get("Stats_Cache_Size", STATS_CACHE_SIZE)
+    if size <= 0:
+        return None
+    try:
+        return ShapeStatsCache(STATS_CACHE_PATH, size)
+    except sqlite3.Error as e:
+        log("Can't open stats cache %s: %s" % (STATS_CACHE_PATH, e))
+        return None
+
+
+def get_shape_stats(roi_service, planes, ch_indexes, batch_size,
+                    pixels_id=None, versions=None):
+    """
+    Fetch intensity stats for many shapes using one call per plane.
+
+    Shapes in the stats cache, if there is one, are not measured again.
+    pixels_id and versions ({shapeId: version}) are the cache key.
+
+    Returns dict of {(shapeId, z, t): ShapeStats}.
+    """
+    shape_stats = {}
+    for (z, t), shape_ids in sorted(planes.items()):
+        if stats_cache is not None:
+            cached = stats_cache.get(
+                pixels_id, z, t, ch_indexes,
+                dict((shape_id, versions.get(shape_id))
+                     for shape_id in shape_ids))
+            shape_stats.update(cached)
+            shape_ids = [shape_id for shape_id in shape_ids
+                         if (shape_id, z, t) not in cached]
+        for i in range(0, len(shape_ids), batch_size):
+            chunk = shape_ids[i:i + batch_size]
+            stats = roi_service.getShapeStatsRestricted(chunk, z, t, ch_indexes)
+            for shape_stat in stats:
+                shape_stats[(shape_stat.shapeId, z, t)] = shape_stat
+            if stats_cache is not None:
+                stats_cache.put(pixels_id, z, t, ch_indexes, versions, stats)
+    return shape_stats
+
+
 def get_export_data(conn, script_params, image, units=None):
     """Get pixel data for shapes on image and returns list of dicts."""
     log("Image ID %s..." % image.id)
@@ -54,6 +236,7 @@ def get_export_data(conn, script_params, image, units=None):
 
     roi_service = conn.getRoiService()
     all_planes = script_params["Export_All_Planes"]
+    batch_size = script_params.get("Stats_Batch_Size", STATS_BATCH_SIZE)
     size_c = image.getSizeC()
     # Channels index
     channels = script_params.get("Channels", [1])
@@ -75,14 +258,13 @@ def get_export_data(conn, script_params, image, units=None):
     rois = result.rois
     # Sort by ROI.id (same as in iviewer)
     rois.sort(key=lambda r: r.id.val)
-    export_data = []
 
+    # Group shape IDs by plane so each plane needs a single stats call
+    shapes = []
+    planes = {}
+    versions = {}
     for roi in rois:
         for shape in roi.copyShapes():
-            label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
-            shape_type = shape.__class__.__name__.rstrip('I').lower()
             # If shape has no Z or T, we may go through all planes...
             the_z = unwrap(shape.theZ)
             z_indexes = [the_z]
@@ -93,36 +275,49 @@ def get_export_data(conn, script_params, image, units=None):
             t_indexes = [the_t]
             if the_t is None and all_planes:
                 t_indexes = range(image.getSizeT())
-
-            # get pixel intensities
+            shapes.append((roi, shape, z_indexes, t_indexes))
             for z in z_indexes:
                 for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
-                    for c, ch_index in enumerate(ch_indexes):
-                        row_data = {
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "channel": ch_names[ch_index],
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else ""
-                        }
-                        add_shape_coords(shape, row_data,
-                                         pixel_size_x, pixel_size_y)
-                        export_data.append(row_data)
+                    if z is not None and t is not None:
+                        planes.setdefault((z, t), []).append(shape.id.val)
+            update_event = shape.details.updateEvent
+            if update_event is not None:
+                versions[shape.id.val] = update_event.id.val
+
+    # get pixel intensities
+    shape_stats = get_shape_stats(roi_service, planes, ch_indexes, batch_size,
+                                  image.getPixelsId(), versions)
+
+    export_data = []
+    for roi, shape, z_indexes, t_indexes in shapes:
+        label = unwrap(shape.getTextValue())
+        # wrap label in double quotes in case it contains comma
+        label = "" if label is None else '"%s"' % label.replace(",", ".")
+        shape_type = shape.__class__.__name__.rstrip('I').lower()
+        for z in z_indexes:
+            for t in t_indexes:
+                stats = shape_stats.get((shape.id.val, z, t))
+                for c, ch_index in enumerate(ch_indexes):
+                    row_data = {
+                        "image_id": image.getId(),
+                        "image_name": '"%s"' % image_name,
+                        "roi_id": roi.id.val,
+                        "shape_id": shape.id.val,
+                        "type": shape_type,
+                        "text": label,
+                        "z": z + 1 if z is not None else "",
+                        "t": t + 1 if t is not None else "",
+                        "channel": ch_names[ch_index],
+                        "points": stats.pointsCount[c] if stats else "",
+                        "min": stats.min[c] if stats else "",
+                        "max": stats.max[c] if stats else "",
+                        "sum": stats.sum[c] if stats else "",
+                        "mean": stats.mean[c] if stats else "",
+                        "std_dev": stats.stdDev[c] if stats else ""
+                    }
+                    add_shape_coords(shape, row_data,
+                                     pixel_size_x, pixel_size_y)
+                    export_data.append(row_data)
 
     return export_data
 
@@ -319,17 +514,28 @@ def run_script():
             "File_Name", grouping="5", default=DEFAULT_FILE_NAME,
             description="Name of the exported CSV file"),
 
+        scripts.Int(
+            "Stats_Batch_Size", grouping="6", default=STATS_BATCH_SIZE,
+            description="Maximum number of shapes measured per call", min=1),
+
+        scripts.Int(
+            "Stats_Cache_Size", grouping="7", default=STATS_CACHE_SIZE,
+            description="Maximum number of shape stats kept between runs."
+                        " 0 (the default) turns the cache off", min=0),
+
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
     )
 
+    global stats_cache
     try:
         conn = BlitzGateway(client_obj=client)
 
         script_params = client.getInputs(unwrap=True)
         log("script_params:")
         log(script_params)
+        stats_cache = open_stats_cache(script_params)
 
         # call the main script
         result = batch_roi_export(conn, script_params)
@@ -345,6 +551,9 @@ def run_script():
         client.setOutput("Message", rstring(message))
 
     finally:
+        if stats_cache is not None:
+            stats_cache.close()
+            stats_cache = None
         client.closeSession()
 
 
@@ -33,12 +33,14 @@ import omero.scripts as scripts
 from omero.gateway import BlitzGateway
 import omero.util.script_utils as script_utils
 import omero
-from omero.rtypes import rstring, rlong, robject
+from omero.rtypes import rstring, rlong, robject, unwrap
 from omero.constants.namespaces import NSCREATED, NSOMETIFF
 import os
 
 import glob
+import threading
 import zipfile
+from collections import deque
 from datetime import datetime
 
 try:
@@ -46,20 +48,68 @@ try:
 except ImportError:
     import Image
 
-# keep track of log strings.
-log_strings = []
+# messages kept in memory by ExportLog
+LOG_RING_SIZE = 1000
+LOG_BUFFER_SIZE = 65536
+LOG_FILE_NAME = "Batch_Image_Export.txt"
+# files with these extensions are stored in the zip without compression
+COMPRESSED_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# rows per page when listing the images in datasets
+IMAGE_ID_BATCH_SIZE = 1000
+# images loaded per query
+IMAGE_QUERY_BATCH_SIZE = 200
 
 
-def log(text):
+class ExportLog(object):
     """
-    Adds the text to a list of logs. Compiled into text file at the end.
+    Writes log messages to a file as they are logged, rather than keeping
+    them all until the end. Only the last ring_size messages are kept in
+    memory, for the summary.
+
+    Messages logged before the file is opened are written when it is, as
+    long as there are no more than ring_size of them.
     """
-    # Handle unicode
-    try:
-        text = text.encode('utf8')
-    except UnicodeEncodeError:
-        pass
-    log_strings.append(str(text))
+
+    def __init__(self, ring_size=LOG_RING_SIZE):
+        self.ring = deque(maxlen=ring_size)
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            self.path = path
+            self.file = open(path, 'w', LOG_BUFFER_SIZE)
+            for text in self.ring:
+                self.file.write(text)
+                self.file.write("\n")
+
+    def write(self, text):
+        with self.lock:
+            self.ring.append(text)
+            if self.file is not None:
+                self.file.write(text)
+                self.file.write("\n")
+
+    def summary(self):
+        """The last messages logged, as a single string."""
+        with self.lock:
+            return "\n".join(self.ring)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# the log of this run
+export_log = ExportLog()
+
+
+def log(text):
+    """Adds the text to the log file, see ExportLog."""
+    export_log.write(str(text))
 
 
 def compress(target, base):
@@ -70,11 +120,17 @@ def compress(target, base):
                         "folder.zip"
     @param base:        Name of folder that we want to zip up E.g. "folder"
     """
-    zip_file = zipfile.ZipFile(target, 'w')
+    zip_file = zipfile.ZipFile(target, 'w', allowZip64=True)
     try:
         files = os.path.join(base, "*")
         for name in glob.glob(files):
-            zip_file.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
+            # JPEG and PNG are already compressed, deflating them again
+            # costs time for almost no gain
+            if name.lower().endswith(COMPRESSED_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            zip_file.write(name, os.path.basename(name), compress_type)
 
     finally:
         zip_file.close()
@@ -268,6 +324,54 @@ def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
                                c, g_scale, zoom_percent, folder_name)
 
 
+def get_dataset_image_ids(conn, dataset_ids, batch_size=IMAGE_ID_BATCH_SIZE):
+    """
+    Finds the images in all of the datasets at once, rather than listing
+    the children of each dataset.
+
+    @return:            List of image IDs, in dataset order, each only once
+                        even if the image is in more than one dataset
+    """
+    query_service = conn.getQueryService()
+    query = ("select link.parent.id, link.child.id "
+             "from DatasetImageLink link "
+             "where link.parent.id in (:ids) "
+             "order by link.parent.id, link.child.id")
+    by_dataset = {}
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addIds(dataset_ids)
+        params.page(offset, batch_size)
+        rows = query_service.projection(query, params, {'omero.group': '-1'})
+        for row in rows:
+            dataset_id, image_id = unwrap(row)
+            by_dataset.setdefault(dataset_id, []).append(image_id)
+        if len(rows) < batch_size:
+            break
+        offset += batch_size
+    image_ids = []
+    seen = set()
+    for dataset_id in dataset_ids:
+        for image_id in by_dataset.get(dataset_id, []):
+            if image_id not in seen:
+                seen.add(image_id)
+                image_ids.append(image_id)
+    return image_ids
+
+
+def iter_images(conn, image_ids, batch_size=IMAGE_QUERY_BATCH_SIZE):
+    """
+    Loads the images with their pixels, batch_size per query, yielding
+    each one as soon as its batch is loaded so that exporting can start
+    before the rest are.
+    """
+    for i in range(0, len(image_ids), batch_size):
+        for image in conn.getObjects("Image", image_ids[i:i + batch_size],
+                                     respect_order=True):
+            yield image
+
+
 def batch_image_export(conn, script_params):
 
     # for params with default values, we can get the value directly
@@ -357,16 +461,18 @@ def batch_image_export(conn, script_params):
     parent = objects[0]
 
     if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
+        # only the IDs for now, the images are loaded as they are exported
+        image_ids = get_dataset_image_ids(conn,
+                                          [ds.getId() for ds in objects])
+        if not image_ids:
             message += "No image found in dataset(s)"
             return None, message
+        images = iter_images(conn, image_ids)
     else:
+        image_ids = [img.getId() for img in objects]
         images = objects
 
-    log("Processing %s images" % len(images))
+    log("Processing %s images" % len(image_ids))
 
     # somewhere to put images
     curr_dir = os.getcwd()
@@ -375,11 +481,15 @@ def batch_image_export(conn, script_params):
         os.mkdir(exp_dir)
     except OSError:
         pass
+    if format != 'OME-TIFF':
+        # log for exported images (not needed for ome-tiff), written as
+        # we go
+        export_log.open(os.path.join(exp_dir, LOG_FILE_NAME))
     # max size (default 12kx12k)
     size = conn.getDownloadAsMaxSizeSetting()
     size = int(size)
 
-    ids = []
+    ids = set()
     # do the saving to disk
 
     for img in images:
@@ -387,12 +497,12 @@ def batch_image_export(conn, script_params):
         pixels = img.getPrimaryPixels()
         if (pixels.getId() in ids):
             continue
-        ids.append(pixels.getId())
+        ids.add(pixels.getId())
 
         if format == 'OME-TIFF':
             if img._prepareRE().requiresPixelsPyramid():
                 log("  ** Can't export a 'Big' image to OME-TIFF. **")
-                if len(images) == 1:
+                if len(image_ids) == 1:
                     return None, "Can't export a 'Big' image to %s." % format
                 continue
             else:
@@ -404,7 +514,7 @@ def batch_image_export(conn, script_params):
                 msg = "Can't export image over %s pixels. " \
                       "See 'omero.client.download_as.max_size'" % size
                 log("  ** %s. **" % msg)
-                if len(images) == 1:
+                if len(image_ids) == 1:
                     return None, msg
                 continue
             else:
@@ -453,14 +563,8 @@ def batch_image_export(conn, script_params):
                 # Make sure we close Rendering Engine
                 img._re.close()
 
-        # write log for exported images (not needed for ome-tiff)
-        name = 'Batch_Image_Export.txt'
-        with open(os.path.join(exp_dir, name), 'w') as log_file:
-            for s in log_strings:
-                log_file.write(s)
-                log_file.write("\n")
-
-    if len(os.listdir(exp_dir)) == 0:
+    export_log.close()
+    if not [f for f in os.listdir(exp_dir) if f != LOG_FILE_NAME]:
         return None, "No files exported. See 'info' for more details"
     # zip everything up (unless we've only got a single ome-tiff)
     if format == 'OME-TIFF' and len(os.listdir(exp_dir)) == 1:
@@ -616,8 +720,12 @@ See http://help.openmicroscopy.org/export.html#batch""",
         if file_annotation is not None:
             client.setOutput("File_Annotation",
                              robject(file_annotation._obj))
-
+    except Exception:
+        # the script's stdout is shown to the user
+        print(export_log.summary())
+        raise
     finally:
+        export_log.close()
         client.closeSession()
 
 
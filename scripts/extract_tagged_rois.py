@@ -9,26 +9,115 @@ import omero.util.script_utils as script_utils
 from omero.gateway import BlitzGateway
 from omero.rtypes import rlong, rint, rstring, robject, unwrap, robject
 from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
-    MaskI, LabelI, PointI
+    MaskI, LabelI, PointI, LengthI
 try:
     from PIL import Image  # see ticket:2597
 except ImportError:
     import Image
+import numpy
 
-from math import sqrt, pi
+from math import sqrt, pi, floor, ceil, isnan
+from array import array
+from collections import namedtuple, OrderedDict, deque
+from io import BytesIO, TextIOWrapper
 import re
 import os
-import glob
+import csv
+import hashlib
+import json
 import zipfile
+import threading
+import queue
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    # no locks, so partial OME-TIFF exports aren't resumed
+    fcntl = None
 
 #set to default, pull from server later in script
 OMERO_MAX_DOWNLOAD_SIZE = 144000000
 DEFAULT_FILE_NAME = "Batch_ROI_Export.csv"
+# max number of shape IDs per getShapeStatsRestricted call
+STATS_BATCH_SIZE = 500
+# max number of stats kept in the local stats cache, see ShapeStatsCache.
+# Off unless Stats_Cache_Size is set
+STATS_CACHE_SIZE = 0
+STATS_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                "extract_tagged_rois_stats.sqlite")
+# byte budget of the local cache of rendered ROIs, see RenderCache. Off
+# unless Render_Cache_MB is set
+RENDER_CACHE_MB = 0
+RENDER_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                 "extract_tagged_rois_renders")
+# rows per page when querying shapes and the images in datasets
+SHAPE_QUERY_BATCH_SIZE = 1000
+# images loaded per query
+IMAGE_QUERY_BATCH_SIZE = 200
+# number of images exported at the same time
+DEFAULT_WORKERS = 4
 INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
-
-# keep track of log strings.
-log_strings = []
+# Format param -> (file extension, PIL format)
+IMAGE_FORMATS = {"JPEG": ("jpg", "JPEG"),
+                 "PNG": ("png", "PNG"),
+                 "TIFF": ("tiff", "TIFF")}
+# numpy dtypes for OMERO pixel types. Raw pixel data is big-endian.
+PIXEL_TYPES = {"int8": ">i1", "uint8": ">u1",
+               "int16": ">i2", "uint16": ">u2",
+               "int32": ">i4", "uint32": ">u4",
+               "float": ">f4", "double": ">f8"}
+
+# log levels, see ExportLog
+DEBUG = 10
+INFO = 20
+# messages kept in memory by ExportLog
+LOG_RING_SIZE = 1000
+LOG_BUFFER_SIZE = 65536
+LOG_LEVELS = {"DEBUG": DEBUG, "INFO": INFO}
+LOG_FILE_NAME = "Logs.txt"
+# ZipPackager that saved files are added to, see archive_file()
+archive = None
+# ShapeStatsCache consulted by get_shape_stats(), if any
+stats_cache = None
+# RenderCache consulted by render_jpeg(), if any
+render_cache = None
+# files with these extensions are stored in the ZIP without compression
+COMPRESSED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".zip", ".gz")
+# max number of files waiting to be written to the archive
+ARCHIVE_QUEUE_SIZE = 64
+# OME-TIFF files are read from the server in blocks of between these sizes,
+# grown or shrunk to take about OME_TIFF_BLOCK_SECONDS each
+OME_TIFF_MIN_BLOCK = 64 * 1024
+OME_TIFF_MAX_BLOCK = 16 * 1024 * 1024
+OME_TIFF_BLOCK_SECONDS = 0.5
+# blocks read but not yet written to disk
+OME_TIFF_QUEUE_SIZE = 4
+# partly exported OME-TIFF files and their checkpoints, kept between runs
+OME_TIFF_PARTIAL_PATH = os.path.join(tempfile.gettempdir(),
+                                     "extract_tagged_rois_ome_tiff")
+# partial OME-TIFF files not written to for this long are deleted
+OME_TIFF_PARTIAL_MAX_AGE = 7 * 24 * 3600
+# namespace of the zip file annotations created by this script
+EXPORT_NS = NSCREATED + "/opt/scripts/extract_tagged_rois"
+INDEX_FILE_NAME = "roi_index_data.csv"
+TIMINGS_FILE_NAME = "timings.json"
+# what was exported last time, see PreviousExport
+MANIFEST_FILE_NAME = "manifest.json"
+# params that change the exported files. Incremental exports are only
+# made on top of an export with the same settings.
+MANIFEST_SETTINGS = ("Export_Individual_Channels", "Individual_Channels_Grey",
+                     "Channel_Names", "Export_Merged_Image", "Crop_To_ROIs",
+                     "Resolution_Level", "Format", "Tag_Delimiter",
+                     "Tags_Filter", "Raw_Pixels", "Mask_Raw_Pixels")
+# ROI image names from make_roi_image_name()
+ROI_IMAGE_NAME_RE = re.compile(r'^roi\d+_shape(\d+)_')
+# image whose files are being saved by the current thread, see ZipPackager
+export_context = threading.local()
 
 
 COLUMN_NAMES = ["image_id",
@@ -48,6 +137,7 @@ COLUMN_NAMES = ["image_id",
                 "sum",
                 "mean",
                 "std_dev",
+                "stats_source",
                 "X",
                 "Y",
                 "Width",
@@ -58,185 +148,295 @@ COLUMN_NAMES = ["image_id",
                 "Y1",
                 "X2",
                 "Y2",
-                "Points"]
-def log(text):
+                "Points",
+                "tag"]
+# Columns kept for each row
+TABLE_COLUMNS = COLUMN_NAMES
+INT_COLUMNS = ("image_id", "roi_id", "shape_id", "z", "t", "points")
+STRING_COLUMNS = ("image_name", "type", "text", "channel", "stats_source",
+                  "Points", "tag")
+# stands in for an empty cell in integer columns, which are never negative
+MISSING_INT = -1
+
+# a shape found by find_tagged_shapes(). version is the ID of the event
+# that last updated the shape.
+TaggedShape = namedtuple("TaggedShape", ["roi_id", "shape_id", "version",
+                                         "tags"])
+# stats from the ShapeStatsCache or measured by measure_shape_pixels(),
+# with the same fields as ShapeStats
+CachedStats = namedtuple("CachedStats", ["shapeId", "pointsCount", "min",
+                                         "max", "sum", "mean", "stdDev"])
+ShapeGeometry = namedtuple("ShapeGeometry", ["area", "length", "bbox",
+                                             "centroid"])
+# an image's pixels and channels, from load_image_meta(). The pixel sizes
+# are Length objects, or None if the image has none. The default Z and T
+# are 0-based.
+ImageMeta = namedtuple("ImageMeta", ["image_id", "name", "pixels_id",
+                                     "size_x", "size_y", "size_z", "size_c",
+                                     "size_t", "pixels_type", "pixel_size_x",
+                                     "pixel_size_y", "channel_labels",
+                                     "default_z", "default_t"])
+# (shape_id, pixel_size_x, pixel_size_y) -> ShapeGeometry
+shape_geometry_cache = {}
+
+
+class RoiTable(object):
     """
-    Adds the text to a list of logs. Compiled into text file at the end.
+    Column-oriented store for the index rows of an image.
+
+    Numeric columns are kept in typed arrays. String columns are kept as
+    codes into a list of their distinct values, since names, types, text and
+    tags repeat on every channel and plane row of a shape. Empty cells are
+    MISSING_INT in integer columns and NaN in float columns.
     """
-    # Handle unicode
-    try:
-        text = text.encode('utf8')
-    except UnicodeEncodeError:
-        pass
-    log_strings.append(str(text))
 
-def get_roi_export_data(conn, script_params, image, units=None):
-    """Get pixel data for shapes on image and returns list of dicts."""
-    log("Image ID %s..." % image.id)
+    def __init__(self):
+        self.columns = {}
+        self.values = {}
+        self.codes = {}
+        for name in TABLE_COLUMNS:
+            if name in STRING_COLUMNS:
+                self.columns[name] = array('i')
+                self.values[name] = []
+                self.codes[name] = {}
+            elif name in INT_COLUMNS:
+                self.columns[name] = array('q')
+            else:
+                self.columns[name] = array('d')
+        # shape_id -> (index of the shape's first row, bounding box)
+        self.bboxes = {}
+
+    def __len__(self):
+        return len(self.columns["shape_id"])
+
+    def append(self, shape_values, **row_values):
+        """
+        Adds a row. Values in row_values take precedence over those in
+        shape_values, which holds what all rows of a shape have in common.
+        Columns in neither are left empty.
+        """
+        for name, column in self.columns.items():
+            if name in row_values:
+                value = row_values[name]
+            else:
+                value = shape_values.get(name, "")
+            if name in self.codes:
+                code = self.codes[name].get(value)
+                if code is None:
+                    code = self.codes[name][value] = len(self.values[name])
+                    self.values[name].append(value)
+                column.append(code)
+            elif value == "" or value is None:
+                column.append(MISSING_INT if column.typecode == 'q'
+                              else float('nan'))
+            else:
+                column.append(value)
+        shape_id = self.columns["shape_id"][-1]
+        if 'bbox' in shape_values and shape_id not in self.bboxes:
+            self.bboxes[shape_id] = (len(self) - 1, shape_values['bbox'])
+
+    def column(self, name):
+        """Returns the values of a column as a list, with "" if empty."""
+        column = self.columns[name]
+        if name in self.codes:
+            values = self.values[name]
+            return [values[code] for code in column]
+        if column.typecode == 'q':
+            return ["" if v == MISSING_INT else v for v in column]
+        return ["" if isnan(v) else v for v in column]
+
+    def row(self, index):
+        """Returns a single row as a dict, with "" for empty cells."""
+        row = {}
+        for name, column in self.columns.items():
+            value = column[index]
+            if name in self.codes:
+                value = self.values[name][value]
+            elif column.typecode == 'q' and value == MISSING_INT:
+                value = ""
+            elif column.typecode == 'd' and isnan(value):
+                value = ""
+            row[name] = value
+        return row
+
+    def write_csv_rows(self, csv_writer, names):
+        """Writes the given columns to a csv writer, returns the row count."""
+        csv_writer.writerows(zip(*[self.column(name) for name in names]))
+        return len(self)
+
+
+class CsvRows(list):
+    """
+    Index rows copied as they are from an earlier export, in the column
+    order of COLUMN_NAMES. Written like a RoiTable.
+    """
 
-    # Get pixel size in SAME units for all images
-    pixel_size_x = None
-    pixel_size_y = None
-    if units is not None:
-        pixel_size_x = image.getPixelSizeX(units=units)
-        pixel_size_x = pixel_size_x.getValue() if pixel_size_x else None
-        pixel_size_y = image.getPixelSizeY(units=units)
-        pixel_size_y = pixel_size_y.getValue() if pixel_size_y else None
+    def write_csv_rows(self, csv_writer, names):
+        """Writes the rows to a csv writer, returns the row count."""
+        csv_writer.writerows(self)
+        return len(self)
 
-    roi_service = conn.getRoiService()
-    all_planes = script_params["Export_All_Planes"]
-    size_c = image.getSizeC()
-    # Channels index
-    channels = script_params.get("Channels", [1])
-    ch_indexes = []
-    for ch in channels:
-        if ch < 1 or ch > size_c:
-            log("Channel index: %s out of range 1 - %s" % (ch, size_c))
-        else:
-            # User input is 1-based
-            ch_indexes.append(ch - 1)
 
-    ch_names = image.getChannelLabels()
-
-    ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
-    image_name = image.getName().replace(",", ".")
-
-    result = roi_service.findByImage(image.getId(), None)
-
-    rois = result.rois
-    # Sort by ROI.id (same as in iviewer)
-    rois.sort(key=lambda r: r.id.val)
-    export_data = []
-
-    for roi in rois:
-        for shape in roi.copyShapes():
-            label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
-            shape_type = shape.__class__.__name__.rstrip('I').lower()
-            # If shape has no Z or T, we may go through all planes...
-            the_z = unwrap(shape.theZ)
-            z_indexes = [the_z]
-            if the_z is None and all_planes:
-                z_indexes = range(image.getSizeZ())
-            # Same for T...
-            the_t = unwrap(shape.theT)
-            t_indexes = [the_t]
-            if the_t is None and all_planes:
-                t_indexes = range(image.getSizeT())
-
-            # get pixel intensities
-            for z in z_indexes:
-                for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
-                    for c, ch_index in enumerate(ch_indexes):
-                        row_data = {
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "channel": ch_names[ch_index],
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else ""
-                        }
-                        add_shape_coords(shape, row_data,
-                                         pixel_size_x, pixel_size_y)
-                        export_data.append(row_data)
-
-    return export_data
+class ExportLog(object):
+    """
+    Writes log messages to a file as they are logged, rather than keeping
+    them all until the end. Only the last ring_size messages are kept in
+    memory, for the summary. Messages below level are dropped.
 
-def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
-    """Add shape coordinates and length or area to the row_data dict."""
-    if shape.getTextValue():
-        row_data['Text'] = shape.getTextValue().getValue()
-    if isinstance(shape, (RectangleI, EllipseI, PointI, LabelI, MaskI)):
-        row_data['X'] = shape.getX().getValue()
-        row_data['Y'] = shape.getY().getValue()
-    if isinstance(shape, (RectangleI, MaskI)):
-        row_data['Width'] = shape.getWidth().getValue()
-        row_data['Height'] = shape.getHeight().getValue()
-        row_data['area'] = row_data['Width'] * row_data['Height']
-    if isinstance(shape, EllipseI):
-        row_data['RadiusX'] = shape.getRadiusX().getValue()
-        row_data['RadiusY'] = shape.getRadiusY().getValue()
-        row_data['area'] = pi * row_data['RadiusX'] * row_data['RadiusY']
-    if isinstance(shape, LineI):
-        row_data['X1'] = shape.getX1().getValue()
-        row_data['X2'] = shape.getX2().getValue()
-        row_data['Y1'] = shape.getY1().getValue()
-        row_data['Y2'] = shape.getY2().getValue()
-        dx = (row_data['X1'] - row_data['X2'])
-        dx = dx if pixel_size_x is None else dx * pixel_size_x
-        dy = (row_data['Y1'] - row_data['Y2'])
-        dy = dy if pixel_size_y is None else dy * pixel_size_y
-        row_data['length'] = sqrt((dx * dx) + (dy * dy))
-    if isinstance(shape, (PolygonI, PolylineI)):
-        point_list = shape.getPoints().getValue()
-        match = INSIGHT_POINT_LIST_RE.search(point_list)
-        if match is not None:
-            point_list = match.group(1)
-        row_data['Points'] = '"%s"' % point_list
-    if isinstance(shape, PolylineI):
-        coords = point_list.split(" ")
-        coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                  for coord in coords]
-        lengths = []
-        for i in range(len(coords)-1):
-            dx = (coords[i][0] - coords[i + 1][0])
-            dy = (coords[i][1] - coords[i + 1][1])
-            dx = dx if pixel_size_x is None else dx * pixel_size_x
-            dy = dy if pixel_size_y is None else dy * pixel_size_y
-            lengths.append(sqrt((dx * dx) + (dy * dy)))
-        row_data['length'] = sum(lengths)
-    if isinstance(shape, PolygonI):
-        # https://www.mathopenref.com/coordpolygonarea.html
-        coords = point_list.split(" ")
-        coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                  for coord in coords]
-        total = 0
-        for c in range(len(coords)):
-            coord = coords[c]
-            next_coord = coords[(c + 1) % len(coords)]
-            total += (coord[0] * next_coord[1]) - (next_coord[0] * coord[1])
-        row_data['area'] = abs(0.5 * total)
-    if 'area' in row_data and pixel_size_x and pixel_size_y:
-        row_data['area'] = row_data['area'] * pixel_size_x * pixel_size_y
+    Messages logged before the file is opened are written when it is, as
+    long as there are no more than ring_size of them.
+    """
 
+    def __init__(self, ring_size=LOG_RING_SIZE, level=DEBUG):
+        self.level = level
+        self.ring = deque(maxlen=ring_size)
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            self.path = path
+            self.file = open(path, 'w', LOG_BUFFER_SIZE)
+            for text in self.ring:
+                self.file.write(text)
+                self.file.write("\n")
+
+    def write(self, text, level=INFO):
+        if level < self.level:
+            return
+        with self.lock:
+            self.ring.append(text)
+            if self.file is not None:
+                self.file.write(text)
+                self.file.write("\n")
+
+    def summary(self):
+        """The last messages logged, as a single string."""
+        with self.lock:
+            return "\n".join(self.ring)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# the log of this run
+export_log = ExportLog()
+
+
+class Timings(object):
+    """
+    Time spent in, and number of calls to, each stage of the export, for
+    the whole run and for each image. Time spent while
+    export_context.image_id is set counts towards that image.
+
+    Stages running on several workers at once overlap, so their times can
+    add up to more than the duration of the run.
+    """
 
-def write_csv(conn, export_data, units_symbol, file_name):
-    """Write the list of data to a CSV file and create a file annotation."""
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        # name -> [calls, seconds]
+        self.stages = {}
+        # image_id -> {name: [calls, seconds]}
+        self.images = {}
+        # name -> count
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times the code in a with block as a call to stage name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds, calls=1):
+        image_id = getattr(export_context, 'image_id', None)
+        with self.lock:
+            stages = [self.stages]
+            if image_id is not None:
+                stages.append(self.images.setdefault(image_id, {}))
+            for stage in stages:
+                totals = stage.setdefault(name, [0, 0.0])
+                totals[0] += calls
+                totals[1] += seconds
+
+    def count(self, name, n=1):
+        """Adds n to counter name, E.g. for cache hits."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """The timings as a dict, ready to be written as JSON."""
+        def stages_dict(stages):
+            return dict((name, {"calls": calls, "seconds": round(seconds, 3)})
+                        for name, (calls, seconds) in stages.items())
+        with self.lock:
+            return {
+                "duration": round(time.time() - self.start, 3),
+                "stages": stages_dict(self.stages),
+                "counters": dict(self.counters),
+                # JSON keys are strings
+                "images": dict((str(image_id), stages_dict(stages))
+                               for image_id, stages in self.images.items()),
+            }
+
+
+# timings of this run
+timings = Timings()
+
+
+def log(text, level=INFO):
+    """
+    Adds the text to the log file, see ExportLog. Use DEBUG for messages
+    about single shapes or files.
+    """
+    export_log.write(str(text), level)
+
+def get_csv_header(units_symbol):
+    """Column names for the CSV file, with units for length and area."""
+    if units_symbol is None:
+        units_symbol = "pixels"
+    header = list(COLUMN_NAMES)
+    header[header.index("length")] = "length (%s)" % units_symbol
+    header[header.index("area")] = "area (%s)" % units_symbol
+    return header
+
+
+def write_csv(conn, tables, units_symbol, file_name):
+    """
+    Write RoiTables to a CSV file and create a file annotation.
+
+    Tables are written one at a time as they are yielded, so tables can be
+    a generator and only one image's rows are held in memory. Values are
+    quoted by the csv module where needed.
+
+    @return:            Tuple of (file annotation, number of rows written)
+    """
     if len(file_name) == 0:
         file_name = DEFAULT_FILE_NAME
     if not file_name.endswith(".csv"):
         file_name += ".csv"
     log("Writing CSV file '%s'" % file_name)
-    csv_header = ",".join(COLUMN_NAMES)
-    if units_symbol is None:
-        units_symbol = "pixels"
-    csv_header = csv_header.replace(",length,", ",length (%s)," % units_symbol)
-    csv_header = csv_header.replace(",area,", ",area (%s)," % units_symbol)
-    csv_rows = [csv_header]
-    log("Found %d rows to export" % len(export_data))
-    for row in export_data:
-        cells = [str(row.get(name, "")) for name in COLUMN_NAMES]
-        csv_rows.append(",".join(cells))
-    log("Writing CSV to disk")
-    with open(file_name, 'w') as csv_file:
-        byte_count = csv_file.write("\n".join(csv_rows))
-    log("Wrote %d bytes" % byte_count)
-    return conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
+    row_count = 0
+    with open(file_name, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file, lineterminator="\n")
+        csv_writer.writerow(get_csv_header(units_symbol))
+        for table in tables:
+            # the time taken to produce the table is counted by the stages
+            # of the export
+            with timings.stage("write_csv"):
+                row_count += table.write_csv_rows(csv_writer, COLUMN_NAMES)
+        byte_count = csv_file.tell()
+    log("Wrote %d rows, %d bytes" % (row_count, byte_count))
+    file_ann = conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
+    return file_ann, row_count
 
 
 def link_annotation(objects, file_ann):
@@ -246,26 +446,427 @@ def link_annotation(objects, file_ann):
             o.linkAnnotation(file_ann)
 
 
-def get_image_pixel_size(image, units):
+def get_image_pixel_size(meta, units):
     if units is not None:
-        r_pixel_size_x = image.getPixelSizeX(units=units)
-        r_pixel_size_y = image.getPixelSizeY(units=units)
-        assert r_pixel_size_x is not None
-        assert r_pixel_size_y is not None
+        assert meta.pixel_size_x is not None
+        assert meta.pixel_size_y is not None
+        # converted locally, without asking the server
+        r_pixel_size_x = LengthI(meta.pixel_size_x, units)
+        r_pixel_size_y = LengthI(meta.pixel_size_y, units)
         return r_pixel_size_x.getValue(), r_pixel_size_y.getValue()
     else:
         #return a tuple with None for entries. Not the same as None!
         return None, None
 
 
-def get_export_data(conn, script_params, image, tag, units=None):
-    """Get pixel data for shapes on image and returns list of dicts."""
-    log("Image ID %s..." % image.id)
+class ShapeStatsCache(object):
+    """
+    Keeps shape stats in a local SQLite database so that shapes measured
+    in an earlier run aren't measured again by the server.
+
+    Stats are keyed by pixels ID, shape ID, shape version (the ID of the
+    event that last updated the shape), Z, T and channel, so editing a
+    shape makes its old stats unreachable. Once there are more than
+    max_entries rows, the least recently used are evicted.
+
+    The database may be locked by another run, so reads and writes that
+    fail are logged and the stats measured by the server instead.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "create table if not exists stats (pixels_id integer, "
+            "shape_id integer, version integer, z integer, t integer, "
+            "c integer, points integer, min real, max real, sum real, "
+            "mean real, std_dev real, last_used real, primary key "
+            "(pixels_id, shape_id, version, z, t, c))")
+        self.db.execute("create index if not exists stats_last_used "
+                        "on stats (last_used)")
+        self.entries = self.db.execute(
+            "select count(*) from stats").fetchone()[0]
+        # last used times of cache hits, written with the next put
+        self.used = []
+
+    def get(self, pixels_id, z, t, ch_indexes, versions):
+        """
+        Looks up the stats of the shapes on a plane. Shapes are only found
+        if all of the channels are cached.
+
+        @param versions:    Dict of {shapeId: version} of the shapes to look
+                            up
+        @return:            Dict of {(shapeId, z, t): CachedStats}
+        """
+        rows = {}
+        with self.lock:
+            try:
+                cursor = self.db.execute(
+                    "select shape_id, version, c, points, min, max, sum, "
+                    "mean, std_dev from stats where pixels_id = ? and z = ? "
+                    "and t = ?", (pixels_id, z, t))
+                for row in cursor:
+                    shape_id, version, c = row[:3]
+                    if versions.get(shape_id) == version:
+                        rows[(shape_id, c)] = row[3:]
+            except sqlite3.Error as e:
+                log("Can't read stats cache: %s" % e)
+                return {}
+            shape_stats = {}
+            now = time.time()
+            for shape_id, version in versions.items():
+                values = [rows.get((shape_id, c)) for c in ch_indexes]
+                if version is None or None in values:
+                    continue
+                # one list per stat, with a value per channel like ShapeStats
+                shape_stats[(shape_id, z, t)] = CachedStats(
+                    shape_id, *[list(v) for v in zip(*values)])
+                self.used.append((now, pixels_id, shape_id, version, z, t))
+        return shape_stats
+
+    def put(self, pixels_id, z, t, ch_indexes, versions, stats):
+        """Stores ShapeStats from the ROI service, see get()."""
+        now = time.time()
+        rows = []
+        for shape_stat in stats:
+            version = versions.get(shape_stat.shapeId)
+            if version is None:
+                continue
+            for i, c in enumerate(ch_indexes):
+                rows.append((pixels_id, shape_stat.shapeId, version, z, t, c,
+                             shape_stat.pointsCount[i], shape_stat.min[i],
+                             shape_stat.max[i], shape_stat.sum[i],
+                             shape_stat.mean[i], shape_stat.stdDev[i], now))
+        with self.lock:
+            try:
+                self._write_used()
+                self.db.executemany(
+                    "insert or replace into stats values "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.commit()
+                self.entries += len(rows)
+                if self.entries > self.max_entries:
+                    self._evict()
+            except sqlite3.Error as e:
+                log("Can't write stats cache: %s" % e)
+                self.db.rollback()
+
+    def _write_used(self):
+        used, self.used = self.used, []
+        self.db.executemany(
+            "update stats set last_used = ? where pixels_id = ? and "
+            "shape_id = ? and version = ? and z = ? and t = ?", used)
+
+    def _evict(self):
+        self.entries = self.db.execute(
+            "select count(*) from stats").fetchone()[0]
+        # evict a tenth more than needed so this doesn't run on every put
+        excess = self.entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            self.db.execute(
+                "delete from stats where rowid in (select rowid from stats "
+                "order by last_used limit ?)", (excess,))
+            self.db.commit()
+            self.entries -= excess
+
+    def close(self):
+        with self.lock:
+            try:
+                self._write_used()
+                self.db.commit()
+            except sqlite3.Error as e:
+                log("Can't write stats cache: %s" % e)
+            self.db.close()
+
+
+def open_stats_cache(script_params):
+    """
+    Opens the stats cache, or returns None if it is turned off or can't be
+    opened.
+    """
+    size = script_params.get("Stats_Cache_Size", STATS_CACHE_SIZE)
+    if size <= 0:
+        return None
+    try:
+        return ShapeStatsCache(STATS_CACHE_PATH, size)
+    except sqlite3.Error as e:
+        log("Can't open stats cache %s: %s" % (STATS_CACHE_PATH, e))
+        return None
+
+
+def get_shape_stats(roi_service, planes, ch_indexes, batch_size,
+                    pixels_id=None, versions=None):
+    """
+    Fetch intensity stats for many shapes using one call per plane.
+
+    @param roi_service:     OMERO ROI service
+    @param planes:          Dict of {(z, t): [shapeId, ...]}, 0-based indices
+    @param ch_indexes:      0-based channel indices to measure
+    @param batch_size:      Maximum number of shape IDs sent in a single call
+    @param pixels_id:       Pixels the shapes are on, for the stats cache
+    @param versions:        Dict of {shapeId: version}, for the stats cache
+    @return:                Dict of {(shapeId, z, t): ShapeStats}. Stats
+                            from the cache are CachedStats
+    """
+    shape_stats = {}
+    for (z, t), shape_ids in sorted(planes.items()):
+        if stats_cache is not None:
+            cached = stats_cache.get(
+                pixels_id, z, t, ch_indexes,
+                dict((shape_id, versions.get(shape_id))
+                     for shape_id in shape_ids))
+            shape_stats.update(cached)
+            timings.count("stats_cache_hits", len(cached))
+            shape_ids = [shape_id for shape_id in shape_ids
+                         if (shape_id, z, t) not in cached]
+        for i in range(0, len(shape_ids), batch_size):
+            chunk = shape_ids[i:i + batch_size]
+            with timings.stage("get_shape_stats"):
+                stats = roi_service.getShapeStatsRestricted(chunk, z, t,
+                                                            ch_indexes)
+            for shape_stat in stats:
+                shape_stats[(shape_stat.shapeId, z, t)] = shape_stat
+            if stats_cache is not None:
+                stats_cache.put(pixels_id, z, t, ch_indexes, versions, stats)
+    return shape_stats
+
+
+def find_tagged_shapes(conn, image_ids, tag_delimiter,
+                       batch_size=SHAPE_QUERY_BATCH_SIZE):
+    """
+    Finds the shapes on the images whose text contains the tag delimiter.
+
+    The filtering is done by the server, and only the IDs and text of the
+    matching shapes are returned, one page of batch_size rows at a time.
+    A '%' or '_' delimiter matches more shapes than it should here, but
+    get_tags() drops those.
+
+    @return:            Generator of (image_id, roi_id, shape_id, version,
+                        text)
+    """
+    query_service = conn.getQueryService()
+    query = ("select roi.image.id, roi.id, shape.id, "
+             "shape.details.updateEvent.id, shape.textValue "
+             "from Shape shape join shape.roi roi "
+             "where roi.image.id in (:ids) "
+             "and shape.textValue like :delimiter "
+             "order by roi.image.id, roi.id, shape.id")
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids)
+        params.addString("delimiter", "%%%s%%" % tag_delimiter)
+        params.page(offset, batch_size)
+        rows = query_service.projection(query, params, {'omero.group': '-1'})
+        for row in rows:
+            yield tuple(unwrap(value) for value in row)
+        if len(rows) < batch_size:
+            break
+        offset += batch_size
+
+
+def build_tag_index(tagged_shapes, tag_re, tags_filter=None):
+    """
+    Reads the tags of shapes found by find_tagged_shapes().
+
+    @return:            Tuple of ({image_id: [TaggedShape, ...]},
+                        {tag: [(image_id, roi_id, shape_id), ...]})
+    """
+    shapes_by_image = {}
+    tag_index = {}
+    for image_id, roi_id, shape_id, version, text in tagged_shapes:
+        tags = get_tags(text, tag_re, tags_filter)
+        if not tags:
+            continue
+        shapes_by_image.setdefault(image_id, []).append(
+            TaggedShape(roi_id, shape_id, version, tags))
+        for tag in tags:
+            tag_index.setdefault(tag, []).append((image_id, roi_id, shape_id))
+    return shapes_by_image, tag_index
+
+
+def get_dataset_image_ids(conn, dataset_ids,
+                          batch_size=SHAPE_QUERY_BATCH_SIZE):
+    """
+    Finds the images in all of the datasets at once, rather than listing
+    the children of each dataset.
+
+    @return:            List of image IDs, in dataset order, each only once
+                        even if the image is in more than one dataset
+    """
+    query_service = conn.getQueryService()
+    query = ("select link.parent.id, link.child.id "
+             "from DatasetImageLink link "
+             "where link.parent.id in (:ids) "
+             "order by link.parent.id, link.child.id")
+    by_dataset = {}
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addIds(dataset_ids)
+        params.page(offset, batch_size)
+        rows = query_service.projection(query, params, {'omero.group': '-1'})
+        for row in rows:
+            dataset_id, image_id = unwrap(row)
+            by_dataset.setdefault(dataset_id, []).append(image_id)
+        if len(rows) < batch_size:
+            break
+        offset += batch_size
+    image_ids = []
+    seen = set()
+    for dataset_id in dataset_ids:
+        for image_id in by_dataset.get(dataset_id, []):
+            if image_id not in seen:
+                seen.add(image_id)
+                image_ids.append(image_id)
+    return image_ids
+
+
+def iter_images(conn, image_ids, batch_size=IMAGE_QUERY_BATCH_SIZE):
+    """
+    Loads the images with their pixels, batch_size per query, yielding
+    each one as soon as its batch is loaded so that exporting can start
+    before the rest are.
+    """
+    for i in range(0, len(image_ids), batch_size):
+        with timings.stage("load_images"):
+            images = list(conn.getObjects("Image",
+                                          image_ids[i:i + batch_size],
+                                          respect_order=True))
+        for image in images:
+            yield image
+
+
+def get_channel_label(channel, index):
+    """
+    Labels a loaded channel the same way as ChannelWrapper.getLabel(): by
+    name, emission wavelength or index, whichever is set first.
+    """
+    logical_channel = channel.getLogicalChannel()
+    label = unwrap(logical_channel.getName())
+    if label is None or len(label.strip()) == 0:
+        emission_wave = logical_channel.getEmissionWave()
+        if emission_wave is not None:
+            label = emission_wave.getValue()
+            if label == int(label):
+                label = int(label)
+    if label is None or len(str(label).strip()) == 0:
+        label = index
+    return str(label)
+
+
+def load_image_meta(conn, image_ids, batch_size=IMAGE_QUERY_BATCH_SIZE):
+    """
+    Loads the pixels and channels of the images, batch_size images per
+    query, so that nothing else needs to ask the server for them.
+
+    @return:            {image_id: ImageMeta}
+    """
+    query_service = conn.getQueryService()
+    query = ("select distinct p from Pixels p "
+             "join fetch p.image "
+             "join fetch p.pixelsType "
+             "left outer join fetch p.channels as ch "
+             "left outer join fetch ch.logicalChannel "
+             "where p.image.id in (:ids)")
+    metas = {}
+    for i in range(0, len(image_ids), batch_size):
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids[i:i + batch_size])
+        with timings.stage("load_image_meta"):
+            loaded = query_service.findAllByQuery(query, params,
+                                                  {'omero.group': '-1'})
+            default_planes = load_default_planes(
+                conn, [pixels.getId().getValue() for pixels in loaded])
+        for pixels in loaded:
+            image = pixels.getImage()
+            channels = [ch for ch in pixels.copyChannels() if ch is not None]
+            default_z, default_t = default_planes.get(
+                pixels.getId().getValue(), (0, 0))
+            metas[image.getId().getValue()] = ImageMeta(
+                image.getId().getValue(), unwrap(image.getName()),
+                pixels.getId().getValue(), unwrap(pixels.getSizeX()),
+                unwrap(pixels.getSizeY()), unwrap(pixels.getSizeZ()),
+                unwrap(pixels.getSizeC()), unwrap(pixels.getSizeT()),
+                unwrap(pixels.getPixelsType().getValue()),
+                pixels.getPhysicalSizeX(), pixels.getPhysicalSizeY(),
+                [get_channel_label(ch, c) for c, ch in enumerate(channels)],
+                default_z, default_t)
+    return metas
+
+
+def load_default_planes(conn, pixels_ids):
+    """
+    Reads the default Z and T of the pixels from their rendering settings,
+    without starting a rendering engine. Like the engine, uses the current
+    user's settings, then those of the owner of the pixels, then any.
+
+    @return:            {pixels_id: (z, t)}, 0-based. Pixels with no
+                        rendering settings are left out
+    """
+    if not pixels_ids:
+        return {}
+    user_id = conn.getUserId()
+    params = omero.sys.ParametersI()
+    params.addIds(pixels_ids)
+    rows = conn.getQueryService().projection(
+        "select r.pixels.id, r.details.owner.id, "
+        "r.pixels.details.owner.id, r.defaultZ, r.defaultT "
+        "from RenderingDef r where r.pixels.id in (:ids)",
+        params, {'omero.group': '-1'})
+    ranked = {}
+    for row in rows:
+        pixels_id, owner_id, pixels_owner_id, z, t = unwrap(row)
+        rank = 0 if owner_id == user_id else \
+            1 if owner_id == pixels_owner_id else 2
+        if pixels_id not in ranked or rank < ranked[pixels_id][0]:
+            ranked[pixels_id] = (rank, (z or 0, t or 0))
+    return dict((pixels_id, plane) for pixels_id, (_, plane)
+                in ranked.items())
+
+
+def load_shapes(conn, shape_ids, batch_size=SHAPE_QUERY_BATCH_SIZE):
+    """Loads shapes by ID, batch_size at a time. Returns {shape_id: shape}"""
+    query_service = conn.getQueryService()
+    query = "select shape from Shape shape where shape.id in (:ids)"
+    shapes = {}
+    for i in range(0, len(shape_ids), batch_size):
+        params = omero.sys.ParametersI()
+        params.addIds(shape_ids[i:i + batch_size])
+        with timings.stage("load_shapes"):
+            loaded = query_service.findAllByQuery(query, params,
+                                                  {'omero.group': '-1'})
+        for shape in loaded:
+            shapes[shape.id.val] = shape
+    return shapes
+
+
+def get_export_data(conn, script_params, meta, tagged_shapes, units=None,
+                    measure=None):
+    """
+    Get pixel data for tagged shapes on image and return them as a RoiTable.
+
+    Only the tagged shapes are loaded, and their stats are fetched once.
+    Each shape gets its rows repeated for every one of its tags.
+
+    @param meta:            ImageMeta of the image, from load_image_meta()
+    @param tagged_shapes:   List of TaggedShape for the image, from
+                            build_tag_index()
+    @param measure:         If given, called with the (row_data, region) of
+                            each shape that has a bounding box and with the
+                            channel indexes, before any stats are fetched.
+                            Returns {(shapeId, z, t): stats} for the shapes
+                            it measured, and the server is only asked for
+                            the stats of the others
+    """
+    log("Image ID %s..." % meta.image_id)
     # Get pixel size in SAME units for all images
-    pixel_size_x, pixel_size_y = get_image_pixel_size(image, units)
+    pixel_size_x, pixel_size_y = get_image_pixel_size(meta, units)
     roi_service = conn.getRoiService()
     all_planes = False
-    size_c = image.getSizeC()
+    batch_size = script_params.get("Stats_Batch_Size", STATS_BATCH_SIZE)
+    size_c = meta.size_c
     # Channels index
     channels = script_params.get("Channels", [1])
     ch_indexes = []
@@ -276,71 +877,181 @@ def get_export_data(conn, script_params, image, tag, units=None):
             # User input is 1-based
             ch_indexes.append(ch - 1)
 
-    ch_names = image.getChannelLabels()
-
-    ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
-    image_name = image.getName().replace(",", ".")
-
-    result = roi_service.findByImage(image.getId(), None)
-
-    rois = result.rois
-    # Sort by ROI.id (same as in iviewer)
-    rois.sort(key=lambda r: r.id.val)
-    export_data = []
-
-    for roi in rois:
-        for shape in roi.copyShapes():
-            label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
-            shape_type = shape.__class__.__name__.rstrip('I').lower()
-            # If shape has no Z or T, we may go through all planes...
-            the_z = unwrap(shape.theZ)
-            z_indexes = [the_z]
-            if the_z is None and all_planes:
-                z_indexes = range(image.getSizeZ())
-            # Same for T...
-            the_t = unwrap(shape.theT)
-            t_indexes = [the_t]
-            if the_t is None and all_planes:
-                t_indexes = range(image.getSizeT())
-
-            # get pixel intensities
+    ch_names = meta.channel_labels
+    image_name = meta.name
+
+    loaded = load_shapes(conn, [s.shape_id for s in tagged_shapes])
+
+    # First pass: work out which planes the shapes need stats for, so that
+    # all shapes on the same plane can be measured in a single call
+    shapes = []
+    planes = {}
+    # Sorted by ROI.id (same as in iviewer)
+    for roi_id, shape_id, _, tags in tagged_shapes:
+        shape = loaded.get(shape_id)
+        if shape is None:
+            continue
+        label = unwrap(shape.getTextValue())
+        # If shape has no Z or T, we may go through all planes...
+        the_z = unwrap(shape.theZ)
+        z_indexes = [the_z]
+        if the_z is None and all_planes:
+            z_indexes = range(meta.size_z)
+        # Same for T...
+        the_t = unwrap(shape.theT)
+        t_indexes = [the_t]
+        if the_t is None and all_planes:
+            t_indexes = range(meta.size_t)
+        # values shared by every row of this shape
+        shape_data = {
+            "image_id": meta.image_id,
+            "image_name": image_name,
+            "roi_id": roi_id,
+            "shape_id": shape_id,
+            "type": shape.__class__.__name__.rstrip('I').lower(),
+            "text": label,
+        }
+        add_shape_coords(shape, shape_data, pixel_size_x, pixel_size_y)
+        shapes.append((shape_data, tags, z_indexes, t_indexes))
+        for z in z_indexes:
+            for t in t_indexes:
+                if z is not None and t is not None:
+                    planes.setdefault((z, t), []).append(shape_id)
+
+    measured = {}
+    if measure is not None:
+        regions = []
+        for shape_data, tags, z_indexes, t_indexes in shapes:
+            region = None
+            if 'bbox' in shape_data:
+                region = clip_region(shape_data['bbox'], meta.size_x,
+                                     meta.size_y)
+            if region is None:
+                continue
+            # 1-based Z and T like the rows, or "" if the shape has none
+            z, t = z_indexes[0], t_indexes[0]
+            row_data = dict(shape_data, z=z + 1 if z is not None else "",
+                            t=t + 1 if t is not None else "")
+            regions.append((row_data, region))
+        measured = measure(regions, ch_indexes)
+        for (z, t), shape_ids in list(planes.items()):
+            shape_ids = [shape_id for shape_id in shape_ids
+                         if (shape_id, z, t) not in measured]
+            if shape_ids:
+                planes[(z, t)] = shape_ids
+            else:
+                del planes[(z, t)]
+        log("  Measured %d shapes from their pixels" % len(measured))
+
+    # get pixel intensities
+    versions = dict((s.shape_id, s.version) for s in tagged_shapes)
+    shape_stats = get_shape_stats(roi_service, planes, ch_indexes, batch_size,
+                                  meta.pixels_id, versions)
+    shape_stats.update(measured)
+
+    table = RoiTable()
+    for shape_data, tags, z_indexes, t_indexes in shapes:
+        for tag in tags:
             for z in z_indexes:
                 for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
+                    key = (shape_data["shape_id"], z, t)
+                    stats = shape_stats.get(key)
+                    # see measure_shape_pixels() for how they differ
+                    source = ""
+                    if key in measured:
+                        source = "pixels"
+                    elif stats:
+                        source = "server"
                     for c, ch_index in enumerate(ch_indexes):
-                        row_data = {
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "channel": ch_names[ch_index],
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else "",
-                            "tag": tag,
-                        }
-                        add_shape_coords(shape, row_data,
-                                         pixel_size_x, pixel_size_y)
-                        export_data.append(row_data)
-
-    return export_data
+                        table.append(
+                            shape_data,
+                            tag=tag,
+                            z=z + 1 if z is not None else "",
+                            t=t + 1 if t is not None else "",
+                            channel=ch_names[ch_index],
+                            points=stats.pointsCount[c] if stats else "",
+                            min=stats.min[c] if stats else "",
+                            max=stats.max[c] if stats else "",
+                            sum=stats.sum[c] if stats else "",
+                            mean=stats.mean[c] if stats else "",
+                            std_dev=stats.stdDev[c] if stats else "",
+                            stats_source=source)
+    return table
+
+
+def parse_points(point_list):
+    """
+    Parses an OMERO point list, E.g. "1,2 3,4 5,6", into an (n, 2) array of
+    x, y coordinates.
+    """
+    coords = numpy.fromstring(point_list.replace(",", " "), sep=" ")
+    if len(coords) % 2:
+        log("  ** Odd number of values in point list, ignoring last one **")
+        coords = coords[:-1]
+    return coords.reshape(-1, 2)
+
+
+def get_shape_geometry(shape_id, point_list, closed, pixel_size_x,
+                       pixel_size_y):
+    """
+    Measures a polygon or polyline, parsing its points only once.
+
+    Results are cached by shape ID and pixel size, so a shape is only
+    measured once per run.
+
+    @param point_list:      Points of the shape, E.g. "1,2 3,4 5,6"
+    @param closed:          True for polygons, False for polylines
+    @return:                ShapeGeometry. Area, bbox and centroid are in
+                            pixels. Length is the perimeter of closed shapes
+                            and is in physical units if pixel sizes are set
+    """
+    key = (shape_id, pixel_size_x, pixel_size_y)
+    geometry = shape_geometry_cache.get(key)
+    if geometry is not None:
+        return geometry
+    coords = parse_points(point_list)
+    x = coords[:, 0]
+    y = coords[:, 1]
+    # segment lengths, including the closing one for polygons
+    if closed:
+        dx = numpy.roll(x, -1) - x
+        dy = numpy.roll(y, -1) - y
+    else:
+        dx = numpy.diff(x)
+        dy = numpy.diff(y)
+    if pixel_size_x is not None:
+        dx = dx * pixel_size_x
+    if pixel_size_y is not None:
+        dy = dy * pixel_size_y
+    length = float(numpy.hypot(dx, dy).sum())
+    # shoelace formula, https://www.mathopenref.com/coordpolygonarea.html
+    cross = x * numpy.roll(y, -1) - numpy.roll(x, -1) * y
+    signed_area = 0.5 * float(cross.sum())
+    if signed_area:
+        centroid = (
+            float(((x + numpy.roll(x, -1)) * cross).sum()) / (6 * signed_area),
+            float(((y + numpy.roll(y, -1)) * cross).sum()) / (6 * signed_area))
+    elif len(coords):
+        centroid = (float(x.mean()), float(y.mean()))
+    else:
+        centroid = (None, None)
+    if len(coords):
+        x_min, y_min = float(x.min()), float(y.min())
+        bbox = (x_min, y_min, float(x.max()) - x_min, float(y.max()) - y_min)
+    else:
+        bbox = None
+    geometry = ShapeGeometry(abs(signed_area), length, bbox, centroid)
+    shape_geometry_cache[key] = geometry
+    return geometry
 
 
 def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
-    """Add shape coordinates and length or area to the row_data dict."""
+    """
+    Add shape coordinates and length or area to the row_data dict.
+
+    For Rectangles, Masks, Ellipses and Polygons the (x, y, width, height)
+    bounding box is also stored under 'bbox'. It is not one of the CSV columns.
+    """
     if shape.getTextValue():
         row_data['Text'] = shape.getTextValue().getValue()
     if isinstance(shape, (RectangleI, EllipseI, PointI, LabelI, MaskI)):
@@ -350,10 +1061,15 @@ def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
         row_data['Width'] = shape.getWidth().getValue()
         row_data['Height'] = shape.getHeight().getValue()
         row_data['area'] = row_data['Width'] * row_data['Height']
+        row_data['bbox'] = (row_data['X'], row_data['Y'],
+                            row_data['Width'], row_data['Height'])
     if isinstance(shape, EllipseI):
         row_data['RadiusX'] = shape.getRadiusX().getValue()
         row_data['RadiusY'] = shape.getRadiusY().getValue()
         row_data['area'] = pi * row_data['RadiusX'] * row_data['RadiusY']
+        row_data['bbox'] = (row_data['X'] - row_data['RadiusX'],
+                            row_data['Y'] - row_data['RadiusY'],
+                            2 * row_data['RadiusX'], 2 * row_data['RadiusY'])
     if isinstance(shape, LineI):
         row_data['X1'] = shape.getX1().getValue()
         row_data['X2'] = shape.getX2().getValue()
@@ -369,63 +1085,323 @@ def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
         match = INSIGHT_POINT_LIST_RE.search(point_list)
         if match is not None:
             point_list = match.group(1)
-        row_data['Points'] = '"%s"' % point_list
+        row_data['Points'] = point_list
+        geometry = get_shape_geometry(shape.id.val, point_list,
+                                      isinstance(shape, PolygonI),
+                                      pixel_size_x, pixel_size_y)
     if isinstance(shape, PolylineI):
-        coords = point_list.split(" ")
-        coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                  for coord in coords]
-        lengths = []
-        for i in range(len(coords)-1):
-            dx = (coords[i][0] - coords[i + 1][0])
-            dy = (coords[i][1] - coords[i + 1][1])
-            dx = dx if pixel_size_x is None else dx * pixel_size_x
-            dy = dy if pixel_size_y is None else dy * pixel_size_y
-            lengths.append(sqrt((dx * dx) + (dy * dy)))
-        row_data['length'] = sum(lengths)
+        row_data['length'] = geometry.length
     if isinstance(shape, PolygonI):
-        # https://www.mathopenref.com/coordpolygonarea.html
-        coords = point_list.split(" ")
-        coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                  for coord in coords]
-        total = 0
-        for c in range(len(coords)):
-            coord = coords[c]
-            next_coord = coords[(c + 1) % len(coords)]
-            total += (coord[0] * next_coord[1]) - (next_coord[0] * coord[1])
-        row_data['area'] = abs(0.5 * total)
+        row_data['area'] = geometry.area
+        row_data['bbox'] = geometry.bbox
     if 'area' in row_data and pixel_size_x and pixel_size_y:
         row_data['area'] = row_data['area'] * pixel_size_x * pixel_size_y
 
 
-def link_annotation(objects, file_ann):
-    """Link the File Annotation to each object."""
-    for o in objects:
-        if o.canAnnotate():
-            o.linkAnnotation(file_ann)
+class ZipPackager(object):
+    """
+    Writes files into a ZIP archive on a background thread as they are
+    produced, so packaging overlaps with rendering instead of running as a
+    last step.
+
+    Formats that are already compressed (JPEG, PNG...) are STORED, since
+    deflating them costs CPU for almost no gain. Everything else (CSV,
+    TIFF, logs) is DEFLATED. zlib releases the GIL, so this runs alongside
+    the export workers.
+
+    In memory mode, rendered images are encoded in memory and written
+    straight into the archive, never touching the disk. The queue is
+    bounded so that rendering waits for the archive rather than piling up
+    encoded images.
+
+    Files added while export_context.image_id is set are recorded, with
+    their checksums, for the manifest of an incremental export.
+    """
+
+    def __init__(self, target, in_memory=False):
+        """
+        @param target:      Name of the zip file we want to write E.g.
+                            "folder.zip"
+        @param in_memory:   If true, save_image() writes into the archive
+                            instead of to disk
+        """
+        self.target = target
+        self.in_memory = in_memory
+        self.zip_file = zipfile.ZipFile(target, 'w', allowZip64=True)
+        self.queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self.names = set()
+        # name -> (image_id, shape_id or None)
+        self.owners = {}
+        # name -> CRC-32 of the data
+        self.checksums = {}
+        self.names_lock = threading.Lock()
+        self.messages = []
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _claim(self, name):
+        with self.names_lock:
+            if name in self.names:
+                log("compress: %s is already in %s" % (name, self.target),
+                    DEBUG)
+                return False
+            self.names.add(name)
+            image_id = getattr(export_context, 'image_id', None)
+            if image_id is not None:
+                match = ROI_IMAGE_NAME_RE.match(name)
+                self.owners[name] = (image_id,
+                                     int(match.group(1)) if match else None)
+            return True
+
+    def add(self, path):
+        """Queues a file to be written to the archive under its basename."""
+        if self._claim(os.path.basename(path)):
+            self.queue.put((path, None))
+
+    def add_bytes(self, name, data):
+        """Queues data to be written to the archive as the file name."""
+        if self._claim(name):
+            self.queue.put((name, data))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path, data):
+        name = os.path.basename(path)
+        if name.lower().endswith(COMPRESSED_EXTENSIONS):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        with timings.stage("compress"):
+            if data is None:
+                self.zip_file.write(path, name, compress_type)
+            else:
+                self.zip_file.writestr(name, data, compress_type)
+        self.checksums[name] = self.zip_file.getinfo(name).CRC
+        msg_str = "compress: Wrote {} to zip file {}".format(path, self.target)
+        self.messages.append(msg_str)
+        log(msg_str, DEBUG)
+
+    def flush(self):
+        """Waits for the files queued so far to be written."""
+        self.queue.join()
+
+    def close(self):
+        """
+        Waits for queued files to be written and closes the archive.
+
+        @return:            Messages about the files written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.zip_file.close()
+        if self.error is not None:
+            raise self.error
+        return '\n'.join(self.messages)
+
 
+def archive_file(path):
+    """Adds a newly saved file to the export archive, if one is open."""
+    if archive is not None:
+        archive.add(path)
 
-def compress(target, base):
+
+def save_image(plane, img_name, pil_format):
+    """
+    Saves a PIL image. If the archive is in memory mode, it is encoded in
+    memory and goes straight into the archive, otherwise it is saved to disk
+    and then added.
     """
-    Creates a ZIP recursively from a given base directory.
+    if archive is not None and archive.in_memory:
+        buf = BytesIO()
+        with timings.stage("encode"):
+            plane.save(buf, pil_format)
+        archive.add_bytes(os.path.basename(img_name), buf.getvalue())
+    else:
+        with timings.stage("encode"):
+            plane.save(img_name, pil_format)
+        archive_file(img_name)
+
+
+def save_image_data(data, img_name):
+    """Like save_image(), for data that is already encoded."""
+    if archive is not None and archive.in_memory:
+        archive.add_bytes(os.path.basename(img_name), data)
+    else:
+        with open(img_name, "wb") as f:
+            f.write(data)
+        archive_file(img_name)
+
 
-    @param target:      Name of the zip file we want to write E.g.
-                        "folder.zip"
-    @param base:        Name of folder that we want to zip up E.g. "folder"
+class RenderCache(object):
     """
-    zip_file = zipfile.ZipFile(target, 'w')
-    messages = []
+    Keeps the JPEGs rendered by the server in a local folder, so that
+    exporting the same ROIs again in another format or with other channel
+    options only has to re-encode them.
+
+    Files are named by a hash of what was rendered: pixels, region, plane
+    and rendering settings, including the version of the saved rendering
+    def so that changing any of its settings is a miss. Once the files take up more than max_bytes, the
+    least recently used are deleted.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum(os.path.getsize(os.path.join(path, f))
+                        for f in os.listdir(path))
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.path, digest + ".jpg")
+
+    def get(self, key):
+        """Returns the cached JPEG or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mark as recently used
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            # not cached, or evicted by another thread
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for f in os.listdir(self.path):
+            path = os.path.join(self.path, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        self.size = sum(size for _, size, _ in files)
+        # evict a tenth more than needed so this doesn't run on every put
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in sorted(files):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+def open_render_cache(script_params):
+    """
+    Opens the render cache, or returns None if it is turned off or can't be
+    opened.
+    """
+    size = script_params.get("Render_Cache_MB", RENDER_CACHE_MB)
+    if size <= 0:
+        return None
     try:
-        files = glob.glob(os.path.join(base, "*"))
-        log("compress: Found the following files in %s" % base)
-        messages.append("\n".join(files))
-        for name in files:
-            zip_file.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
-            msg_str = "compress: Wrote {} to zip file {}".format(name, base)
-            messages.append(msg_str)
-            log(msg_str)
-    finally:
-        zip_file.close()
-    return '\n'.join(messages)
+        return RenderCache(RENDER_CACHE_PATH, size * 1024 * 1024)
+    except (IOError, OSError) as e:
+        log("Can't open render cache %s: %s" % (RENDER_CACHE_PATH, e))
+        return None
+
+
+def render_jpeg(image, render_key, z, t, region=None, level=None):
+    """
+    Renders a plane, or a region of it, as a JPEG. Uses the render cache if
+    there is one and render_key is set.
+
+    @param render_key:      From set_rendering_channel()
+    @param z:               0-based Z index
+    @param t:               0-based T index
+    @param region:          Tuple of (x, y, width, height), or None for the
+                            whole plane
+    @return:                JPEG data, or None if rendering failed
+    """
+    key = None
+    if render_cache is not None and render_key is not None:
+        key = (image.getPixelsId(), render_key, z, t, region, level)
+        jpeg_data = render_cache.get(key)
+        if jpeg_data is not None:
+            timings.count("render_cache_hits")
+            return jpeg_data
+    with timings.stage("render"):
+        if region is None:
+            jpeg_data = image.renderJpeg(z, t)
+        else:
+            x, y, width, height = region
+            jpeg_data = image.renderJpegRegion(z, t, x, y, width, height,
+                                               level=level)
+    if jpeg_data is not None and key is not None:
+        render_cache.put(key, jpeg_data)
+    return jpeg_data
+
+
+def get_rendering_def_version(image):
+    """
+    Identifies the saved rendering settings the image's engine started
+    from: the rendering def ID and the ID of the event that last updated
+    it, which changes whenever any of them (LUTs, reverse intensity,
+    quantization...) are saved again.
+    """
+    rdef_id = image._re.getRenderingDefId()
+    params = omero.sys.ParametersI()
+    params.addId(rdef_id)
+    rows = image._conn.getQueryService().projection(
+        "select r.details.updateEvent.id from RenderingDef r "
+        "where r.id = :id", params, {'omero.group': '-1'})
+    return rdef_id, unwrap(rows[0][0]) if rows else None
+
+
+def set_rendering_channel(image, channel, greyscale):
+    """
+    Sets the active channel and rendering model before rendering.
+
+    @param channel:         Active channel index. If None, use current
+                            rendering settings
+    @param greyscale:       If true, the channel is rendered greyscale
+    @return:                A key for the resulting rendering settings, for
+                            the render cache. None if there is no cache
+    """
+    if channel is not None:
+        image.setActiveChannels([channel+1])    # use 1-based Channel indices
+        if greyscale:
+            image.setGreyscaleRenderingModel()
+        else:
+            image.setColorRenderingModel()
+    if render_cache is None:
+        return None
+    return (get_rendering_def_version(image),
+            image.isGreyscaleRenderingModel(), image.getProjection(),
+            tuple((ch.isActive(), ch.getWindowStart(), ch.getWindowEnd(),
+                   ch.getColor().getHtml()) for ch in image.getChannels()))
+
 
 """NMS: The use of 'save' here may be confusing at first. It's actually calling
 the .save method on a PIL image object. Omero server manages the IO ops called
@@ -436,10 +1412,11 @@ of Omero-server, which appears like an OS as far as Python's concerned.
 
 Not certain I understand it yet.
 """
-def save_plane(image, format, c_name, z_range, project_z, t=0, channel=None,
-               greyscale=False, zoom_percent=None, folder_name=None):
+def save_plane(image, format, c_name, z_range, project_z, t=0,
+               zoom_percent=None, folder_name=None, render_key=None):
     """
-    Renders and saves an image to disk.
+    Renders and saves an image to disk, with the channels already set by
+    set_rendering_channel().
 
     @param image:           The image to render
     @param format:          The format to save as
@@ -447,28 +1424,17 @@ def save_plane(image, format, c_name, z_range, project_z, t=0, channel=None,
     @param z_range:         Tuple of (zIndex,) OR (zStart, zStop) for
                             projection
     @param t:               T index
-    @param channel:         Active channel index. If None, use current
-                            rendering settings
-    @param greyscale:       If true, all visible channels will be
-                            greyscale
     @param zoom_percent:    Resize image by this percent if specified
     @param folder_name:     Indicate where to save the plane
     """
 
     original_name = image.getName()
-    log("")
-    log("save_plane..")
-    log("channel: %s" % c_name)
-    log("z: %s" % z_range)
-    log("t: %s" % t)
+    log("", DEBUG)
+    log("save_plane..", DEBUG)
+    log("channel: %s" % c_name, DEBUG)
+    log("z: %s" % z_range, DEBUG)
+    log("t: %s" % t, DEBUG)
 
-    # if channel == None: use current rendering settings
-    if channel is not None:
-        image.setActiveChannels([channel+1])    # use 1-based Channel indices
-        if greyscale:
-            image.setGreyscaleRenderingModel()
-        else:
-            image.setColorRenderingModel()
     if project_z:
         # imageWrapper only supports projection of full Z range (can't
         # specify)
@@ -479,28 +1445,89 @@ def save_plane(image, format, c_name, z_range, project_z, t=0, channel=None,
     #NMS: renderImage is somewhere in the Blitz Gateway wrappers
     #See https://downloads.openmicroscopy.org/omero/5.5.1/api/python/omero/omero.gateway.html
     #'plane' is a PIL image object, as described in the docs at the lnk above
-    plane = image.renderImage(z_range[0]-1, t-1)
-    if zoom_percent:
+    #renderImage() is a JPEG from renderJpeg() opened with PIL, so do the
+    #same here, through the render cache
+    if project_z:
+        render_key = render_key and render_key + ('intmax',)
+    jpeg_data = render_jpeg(image, render_key, z_range[0]-1, t-1)
+    if jpeg_data is None:
+        log("  ** Failed to render plane. **")
+        return
+    plane = Image.open(BytesIO(jpeg_data))
+    if zoom_percent and zoom_percent != 100:
         w, h = plane.size
         fraction = (float(zoom_percent) / 100)
         plane = plane.resize((int(w * fraction), int(h * fraction)),
-                             Image.ANTIALIAS)
+                             Image.LANCZOS)
 
     if format == "PNG":
         img_name = make_image_name(
             original_name, c_name, z_range, t, "png", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name, "PNG")
+        log("Saving image: %s" % img_name, DEBUG)
+        save_image(plane, img_name, "PNG")
     elif format == 'TIFF':
         img_name = make_image_name(
             original_name, c_name, z_range, t, "tiff", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name, 'TIFF')
+        log("Saving image: %s" % img_name, DEBUG)
+        save_image(plane, img_name, 'TIFF')
     else:
         img_name = make_image_name(
             original_name, c_name, z_range, t, "jpg", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name)
+        log("Saving image: %s" % img_name, DEBUG)
+        save_image(plane, img_name, 'JPEG')
+
+
+class NameRegistry(object):
+    """
+    Hands out output file names that don't collide with one another, so
+    that we don't have to probe the file system for a free name. A name
+    that is already taken gets a suffix from a counter kept per name,
+    E.g. myImage.png, myImage_(1).png, myImage_(2).png...
+    """
+
+    def __init__(self):
+        self.used = set()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def reset(self, folder_name=None):
+        """
+        Forgets all names, then reserves the files already in folder_name
+        (if any) so that we don't overwrite them.
+        """
+        with self.lock:
+            self.used = set()
+            self.counters = {}
+            if folder_name is not None and os.path.isdir(folder_name):
+                for f in os.listdir(folder_name):
+                    self.used.add(os.path.join(folder_name, f))
+
+    def reserve(self, img_name):
+        """Marks a name as taken without checking for collisions."""
+        with self.lock:
+            self.used.add(img_name)
+
+    def unique(self, img_name, extension):
+        """
+        Reserves img_name, or the first free img_name_(n) if it is taken.
+        """
+        with self.lock:
+            if img_name not in self.used:
+                self.used.add(img_name)
+                return img_name
+            name = img_name[:-(len(extension)+1)]
+            i = self.counters.get(img_name, 1)
+            unique_name = "%s_(%d).%s" % (name, i, extension)
+            while unique_name in self.used:
+                i += 1
+                unique_name = "%s_(%d).%s" % (name, i, extension)
+            self.counters[img_name] = i + 1
+            self.used.add(unique_name)
+            return unique_name
+
+
+# names of the files written by this export, see NameRegistry
+file_names = NameRegistry()
 
 
 def make_image_name(original_name, c_name, z_range, t, extension, folder_name):
@@ -518,14 +1545,601 @@ def make_image_name(original_name, c_name, z_range, t, extension, folder_name):
     if folder_name is not None:
         img_name = os.path.join(folder_name, img_name)
     # check we don't overwrite existing file
-    i = 1
-    name = img_name[:-(len(extension)+1)]
-    while os.path.exists(img_name):
-        img_name = "%s_(%d).%s" % (name, i, extension)
-        i += 1
+    return file_names.unique(img_name, extension)
+
+
+def get_roi_regions(table, size_x, size_y):
+    """
+    Picks the region to render for each shape in a RoiTable.
+
+    Each shape is listed once, even if it has rows for several channels or
+    tags. Bounding boxes are clipped to the image, and shapes without one
+    (lines, points, labels...) are left out.
+
+    @param table:           RoiTable from get_export_data()
+    @param size_x:          Width of the image
+    @param size_y:          Height of the image
+    @return:                List of (row_data, (x, y, width, height)), where
+                            row_data is the shape's first row as a dict
+    """
+    regions = []
+    for shape_id, (index, bbox) in table.bboxes.items():
+        region = clip_region(bbox, size_x, size_y)
+        if region is None:
+            log("  ** Shape %s is outside the image. **" % shape_id)
+            continue
+        regions.append((table.row(index), region))
+    return regions
+
+
+def clip_region(bbox, size_x, size_y):
+    """
+    Rounds a bounding box out to whole pixels and clips it to the image.
+
+    @return:                Tuple of (x, y, width, height), or None if the
+                            box is outside the image
+    """
+    x, y, width, height = bbox
+    x0 = max(0, int(floor(x)))
+    y0 = max(0, int(floor(y)))
+    x1 = min(size_x, int(ceil(x + width)))
+    y1 = min(size_y, int(ceil(y + height)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def save_roi(image, format, c_name, row_data, region, z, t,
+             zoom_percent=None, folder_name=None, level=None, render_key=None):
+    """
+    Renders only the region around one shape and saves it to disk, with the
+    channels already set by set_rendering_channel().
+
+    @param image:           The image to render
+    @param format:          The format to save as
+    @param c_name:          The name to use
+    @param row_data:        Row for the shape, from get_export_data()
+    @param region:          Tuple of (x, y, width, height) to render
+    @param z:               Z index
+    @param t:               T index
+    @param zoom_percent:    Resize image by this percent if specified
+    @param folder_name:     Indicate where to save the ROI
+    @param level:           Rendering engine resolution level, region is
+                            in the coordinates of that level. If None, use
+                            full resolution
+    """
+    log("save_roi: ROI %s, shape %s, region %s, channel %s"
+        % (row_data['roi_id'], row_data['shape_id'], region, c_name), DEBUG)
+    if region_too_large(region):
+        return
+
+    # All Z and T indices in this script are 1-based, but this method uses
+    # 0-based.
+    x, y, width, height = region
+    jpeg_data = render_jpeg(image, render_key, z-1, t-1, region, level)
+    if jpeg_data is None:
+        log("  ** Failed to render region %s. **" % (region,))
+        return
+
+    extension, pil_format = IMAGE_FORMATS.get(format, IMAGE_FORMATS["JPEG"])
+    img_name = make_roi_image_name(row_data['roi_id'], row_data['shape_id'],
+                                   c_name, z, t, extension, folder_name)
+    log("Saving image: %s" % img_name, DEBUG)
+    resize = zoom_percent and zoom_percent != 100
+    if pil_format == "JPEG" and not resize:
+        # The rendering engine already gave us a JPEG, no need to re-encode
+        save_image_data(jpeg_data, img_name)
+        return
+    plane = Image.open(BytesIO(jpeg_data))
+    if resize:
+        fraction = (float(zoom_percent) / 100)
+        plane = plane.resize((int(width * fraction), int(height * fraction)),
+                             Image.LANCZOS)
+    save_image(plane, img_name, pil_format)
+
+
+def region_too_large(region):
+    """Checks a region against the server's download size limit."""
+    x, y, width, height = region
+    if width * height > OMERO_MAX_DOWNLOAD_SIZE:
+        log("  ** Can't export region %s over %s pixels. **"
+            % (region, OMERO_MAX_DOWNLOAD_SIZE))
+        return True
+    return False
+
+
+def make_roi_image_name(roi_id, shape_id, c_name, z, t, extension,
+                        folder_name):
+    """
+    Produces the name for a saved ROI image, E.g. roi12_shape34_DAPI_z01_t01.png
+    ROI and shape IDs are unique so there is no need to check for existing
+    files.
+    """
+    img_name = "roi%s_shape%s_%s_z%02d_t%02d.%s" % (roi_id, shape_id, c_name,
+                                                    z, t, extension)
+    if folder_name is not None:
+        img_name = os.path.join(folder_name, img_name)
     return img_name
 
 
+def save_rois_for_image(image, regions, size_c, split_cs, merged_cs,
+                        channel_names=None, greyscale=False, zoom_percent=None,
+                        format="JPEG", folder_name=None):
+    """
+    Saves the region around each tagged shape for a single image.
+
+    Shapes are rendered on their own Z and T planes, falling back to the
+    image's default Z or T for shapes that have none.
+
+    @param regions:             List of (row_data, region) from
+                                get_roi_regions()
+    @param greyscale:           If true, all visible channels will be
+                                greyscale
+    @param zoom_percent:        Resize image by this percent if specified.
+    """
+    channels = []
+    if merged_cs:
+        # render merged first with current rendering settings
+        channels.append(None)
+    if split_cs:
+        for i in range(size_c):
+            channels.append(i)
+
+    default_z = image.getDefaultZ()+1
+    default_t = image.getDefaultT()+1
+    c_name = 'merged'
+    for c in channels:
+        if c is not None:
+            g_scale = greyscale
+            if c < len(channel_names):
+                c_name = channel_names[c].replace(" ", "_")
+            else:
+                c_name = "c%02d" % c
+        else:
+            # if we're rendering 'merged' image - don't want grey!
+            g_scale = False
+        # set once for all the regions rendered with this channel
+        render_key = set_rendering_channel(image, c, g_scale)
+        for row_data, region in regions:
+            # rows use 1-based Z and T, or "" if the shape has none
+            z = row_data['z'] or default_z
+            t = row_data['t'] or default_t
+            save_roi(image, format, c_name, row_data, region, z, t,
+                     zoom_percent, folder_name, render_key=render_key)
+
+
+def requires_tiled_export(image, meta):
+    """
+    Checks whether ROIs must be read tile by tile, either because the image
+    is pyramidal or because whole planes are over the download limit.
+    """
+    if meta.size_x * meta.size_y > OMERO_MAX_DOWNLOAD_SIZE:
+        return True
+    if image._re is not None:
+        # the image's own engine, left open for rendering
+        return image._re.requiresPixelsPyramid()
+    re = image._prepareRE()
+    try:
+        return re.requiresPixelsPyramid()
+    finally:
+        re.close()
+
+
+def open_raw_pixels_store(conn, pixels_id, level):
+    """
+    Opens a raw pixels store at the requested pyramid level.
+
+    @param level:       Resolution level, 0 is full resolution and higher
+                        numbers are smaller. Clamped to the smallest level
+    @return:            Tuple of (store, engine level, size X, size Y). The
+                        engine level is the same level numbered the way
+                        the rendering engine counts, smallest first
+    """
+    store = conn.createRawPixelsStore()
+    store.setPixelsId(pixels_id, True)
+    descriptions = store.getResolutionDescriptions()
+    level = min(max(level, 0), len(descriptions) - 1)
+    engine_level = len(descriptions) - 1 - level
+    store.setResolutionLevel(engine_level)
+    return (store, engine_level, descriptions[level].sizeX,
+            descriptions[level].sizeY)
+
+
+def scale_region(region, scale_x, scale_y, size_x, size_y):
+    """Scales a full resolution region to a pyramid level, clipped to it."""
+    x, y, width, height = region
+    x0 = int(floor(x * scale_x))
+    y0 = int(floor(y * scale_y))
+    x1 = min(size_x, max(x0 + 1, int(ceil((x + width) * scale_x))))
+    y1 = min(size_y, max(y0 + 1, int(ceil((y + height) * scale_y))))
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def read_tiled_region(store, region, z, c, t, dtype, shared=None):
+    """
+    Reads one channel of a region, tile by tile.
+
+    Only the tiles that intersect the region are requested, and each one is
+    copied straight into a buffer allocated up front, so memory use is
+    bounded by the size of the region rather than the plane. Tiles other
+    regions also need are taken from shared, if given.
+
+    @param store:       Raw pixels store, set to the right resolution level
+    @param region:      Tuple of (x, y, width, height) at that level
+    @param z:           0-based Z index
+    @param c:           0-based channel index
+    @param t:           0-based T index
+    @param dtype:       Big-endian numpy dtype of the raw pixel data
+    @param shared:      SharedTiles of the plane the region is on
+    @return:            2D numpy array of shape (height, width)
+    """
+    x, y, width, height = region
+    if shared is not None:
+        tile_w, tile_h = shared.tile_w, shared.tile_h
+    else:
+        tile_w, tile_h = store.getTileSize()
+    buf = numpy.empty((height, width), dtype=dtype.newbyteorder("="))
+    for tile_y in range(y - y % tile_h, y + height, tile_h):
+        for tile_x in range(x - x % tile_w, x + width, tile_w):
+            # part of this tile that falls inside the region
+            x0 = max(tile_x, x)
+            y0 = max(tile_y, y)
+            x1 = min(tile_x + tile_w, x + width)
+            y1 = min(tile_y + tile_h, y + height)
+            if shared is not None:
+                part = shared.get(store, z, c, t, tile_x, tile_y, dtype)
+                if part is not None:
+                    tile, px, py = part
+                    buf[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                        tile[y0 - py:y1 - py, x0 - px:x1 - px]
+                    continue
+            with timings.stage("read_tiles"):
+                raw = store.getTile(z, c, t, x0, y0, x1 - x0, y1 - y0)
+            tile = numpy.frombuffer(raw, dtype=dtype)
+            buf[y0 - y:y1 - y, x0 - x:x1 - x] = tile.reshape(y1 - y0, x1 - x0)
+    return buf
+
+
+def array_to_image(data):
+    """
+    Wraps raw pixel data in a PIL image, converting types PIL can't use.
+    Returns None if the values can't be kept, which is the case for uint32
+    values of 2**31 and over.
+    """
+    if data.dtype.kind == "f":
+        data = data.astype(numpy.float32)
+    elif data.dtype not in (numpy.uint8, numpy.uint16):
+        if data.dtype == numpy.uint32 and data.size and \
+                data.max() > numpy.iinfo(numpy.int32).max:
+            return None
+        data = data.astype(numpy.int32)
+    return Image.fromarray(data)
+
+
+def save_array(data, img_name):
+    """Saves raw pixel data as a NumPy .npy file."""
+    buf = BytesIO()
+    with timings.stage("encode"):
+        numpy.save(buf, data)
+    save_image_data(buf.getvalue(), img_name)
+
+
+def save_rois_tiled(conn, image, meta, regions, split_cs, merged_cs,
+                    channel_names=None, level=0, format="JPEG",
+                    folder_name=None):
+    """
+    Saves the region around each tagged shape of a big image using raw pixel
+    tiles rather than the rendering engine.
+
+    Individual channels are saved with their raw pixel values. The merged
+    image is built from the raw channels for 8-bit RGB images like
+    brightfield slides, and rendered region by region for anything else.
+    8-bit data is saved in the chosen format, everything else as TIFF.
+
+    @param meta:                ImageMeta of the image
+    @param regions:             List of (row_data, region) from
+                                get_roi_regions(), at full resolution
+    @param level:               Resolution level, 0 is full resolution
+    """
+    size_c = meta.size_c
+    pixels_type = meta.pixels_type
+    if pixels_type not in PIXEL_TYPES:
+        log("  ** Can't read %s pixels tile by tile. **" % pixels_type)
+        return
+    dtype = numpy.dtype(PIXEL_TYPES[pixels_type])
+    is_rgb = size_c == 3 and pixels_type == "uint8"
+    render_key = None
+    if merged_cs and not is_rgb:
+        render_key = set_rendering_channel(image, None, False)
+    default_z = image.getDefaultZ()
+    default_t = image.getDefaultT()
+
+    store, engine_level, size_x, size_y = open_raw_pixels_store(
+        conn, meta.pixels_id, level)
+    try:
+        scale_x = float(size_x) / meta.size_x
+        scale_y = float(size_y) / meta.size_y
+        log("  Resolution level %s: %s x %s" % (level, size_x, size_y))
+        for row_data, full_region in regions:
+            region = scale_region(full_region, scale_x, scale_y,
+                                  size_x, size_y)
+            if region_too_large(region):
+                continue
+            # rows use 1-based Z and T, or "" if the shape has none
+            z = row_data['z'] - 1 if row_data['z'] else default_z
+            t = row_data['t'] - 1 if row_data['t'] else default_t
+            to_save = []
+            if merged_cs and is_rgb:
+                to_save.append(('merged', numpy.dstack(
+                    [read_tiled_region(store, region, z, c, t, dtype)
+                     for c in range(size_c)])))
+            elif merged_cs:
+                save_roi(image, format, 'merged', row_data, region,
+                         z + 1, t + 1, folder_name=folder_name,
+                         level=engine_level, render_key=render_key)
+            if split_cs:
+                for c in range(size_c):
+                    if c < len(channel_names):
+                        c_name = channel_names[c].replace(" ", "_")
+                    else:
+                        c_name = "c%02d" % c
+                    to_save.append((c_name, read_tiled_region(
+                        store, region, z, c, t, dtype)))
+            for c_name, data in to_save:
+                plane = array_to_image(data)
+                extension, pil_format = IMAGE_FORMATS.get(
+                    format, IMAGE_FORMATS["JPEG"])
+                if plane is None:
+                    # too big for a TIFF, keep the values as they are
+                    extension, pil_format = "npy", None
+                elif pixels_type != "uint8" and pil_format != "TIFF":
+                    extension, pil_format = IMAGE_FORMATS["TIFF"]
+                img_name = make_roi_image_name(
+                    row_data['roi_id'], row_data['shape_id'], c_name, z + 1,
+                    t + 1, extension, folder_name)
+                log("Saving image: %s" % img_name, DEBUG)
+                if plane is None:
+                    save_array(data, img_name)
+                else:
+                    save_image(plane, img_name, pil_format)
+    finally:
+        store.close()
+
+
+class SharedTiles(object):
+    """
+    The tiles of a plane that more than one region intersects. The part of
+    such a tile that those regions cover is read the first time one of
+    them is, and kept until the last of them has been, so that ROIs close
+    to each other share their reads without reading the pixels between
+    ROIs that are far apart.
+    """
+
+    def __init__(self, regions, tile_size):
+        """
+        @param regions:     List of (x, y, width, height) that will be read
+        @param tile_size:   From store.getTileSize()
+        """
+        self.tile_w, self.tile_h = tile_size
+        # (tile_x, tile_y) -> [regions, x0, y0, x1, y1 covered by them]
+        users = {}
+        for x, y, width, height in regions:
+            for tile_x, tile_y in self.tiles_of((x, y, width, height)):
+                box = (max(tile_x, x), max(tile_y, y),
+                       min(tile_x + self.tile_w, x + width),
+                       min(tile_y + self.tile_h, y + height))
+                used = users.get((tile_x, tile_y))
+                if used is None:
+                    users[(tile_x, tile_y)] = [1] + list(box)
+                else:
+                    used[0] += 1
+                    used[1:] = [min(used[1], box[0]), min(used[2], box[1]),
+                                max(used[3], box[2]), max(used[4], box[3])]
+        self.users = dict((tile, used) for tile, used in users.items()
+                          if used[0] > 1)
+        # (c, tile_x, tile_y) -> [data, regions left to read]
+        self.tiles = {}
+
+    def tiles_of(self, region):
+        """Yields the (x, y) of the tiles that intersect the region."""
+        x, y, width, height = region
+        for tile_y in range(y - y % self.tile_h, y + height, self.tile_h):
+            for tile_x in range(x - x % self.tile_w, x + width, self.tile_w):
+                yield tile_x, tile_y
+
+    def get(self, store, z, c, t, tile_x, tile_y, dtype):
+        """
+        Returns the covered part of a tile and its (x, y), reading it if it
+        isn't kept yet, or None if only one region intersects the tile.
+        """
+        used = self.users.get((tile_x, tile_y))
+        if used is None:
+            return None
+        key = (c, tile_x, tile_y)
+        entry = self.tiles.get(key)
+        if entry is None:
+            count, x0, y0, x1, y1 = used
+            with timings.stage("read_tiles"):
+                raw = store.getTile(z, c, t, x0, y0, x1 - x0, y1 - y0)
+            data = numpy.frombuffer(raw, dtype=dtype).reshape(y1 - y0,
+                                                              x1 - x0)
+            entry = self.tiles[key] = [(data, x0, y0), count]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.tiles[key]
+        return entry[0]
+
+
+def make_shape_mask(row_data, region):
+    """
+    Finds the pixels of a region that are inside a rectangle, ellipse or
+    polygon. A pixel is inside if its centre is, so a rectangle with
+    fractional coordinates doesn't get the pixels it only partly covers.
+
+    @param row_data:            Row for the shape, from get_export_data()
+    @param region:              Tuple of (x, y, width, height)
+    @return:                    2D bool array of shape (height, width), or
+                                None for shapes that fill their region
+    """
+    x, y, width, height = region
+    # pixel centres, as a row and a column so that they broadcast
+    px = numpy.arange(width) + x + 0.5
+    py = (numpy.arange(height) + y + 0.5)[:, numpy.newaxis]
+    if row_data['type'] == 'rectangle':
+        # right and bottom edges excluded, so rectangles that touch don't
+        # share pixels
+        inside = (px >= row_data['X']) & \
+            (px < row_data['X'] + row_data['Width']) & \
+            (py >= row_data['Y']) & (py < row_data['Y'] + row_data['Height'])
+        return None if inside.all() else inside
+    if row_data['type'] == 'ellipse':
+        dx = (px - row_data['X']) / row_data['RadiusX']
+        dy = (py - row_data['Y']) / row_data['RadiusY']
+        return dx * dx + dy * dy <= 1
+    if row_data['type'] == 'polygon':
+        coords = parse_points(row_data['Points'])
+        inside = numpy.zeros((height, width), dtype=bool)
+        # even-odd rule: count the edges crossed going right from each pixel
+        for (x1, y1), (x2, y2) in zip(coords, numpy.roll(coords, -1, 0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > py) != (y2 > py)
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (px < x_cross)
+        return inside
+    return None
+
+
+def measure_shape_pixels(shape_id, data, mask):
+    """
+    Measures the pixels of a shape in all channels at once.
+
+    The pixels counted are those of make_shape_mask(), whose centres are
+    inside the shape, and the standard deviation is that of the population
+    (divided by the number of points). Neither is checked against
+    getShapeStatsRestricted, so the stats can differ a little from the
+    server's, which is why rows give their "stats_source".
+
+    @param data:                Array of (channels, height, width)
+    @param mask:                2D bool array of the pixels in the shape, or
+                                None if they all are
+    @return:                    CachedStats, with a value for each channel
+    """
+    if mask is None:
+        values = data.reshape(data.shape[0], -1)
+    else:
+        values = data[:, mask]
+    values = values.astype(numpy.float64)
+    count = values.shape[1]
+    if count == 0:
+        return None
+    return CachedStats(shape_id, [count] * data.shape[0],
+                       values.min(axis=1).tolist(),
+                       values.max(axis=1).tolist(),
+                       values.sum(axis=1).tolist(),
+                       values.mean(axis=1).tolist(),
+                       values.std(axis=1).tolist())
+
+
+def save_raw_roi(data, row_data, z, t, format, folder_name=None):
+    """
+    Saves the raw pixels of a ROI, an array of (channels, height, width),
+    as a multi-page TIFF if format is TIFF and as a NumPy .npy file
+    otherwise, or if the values don't fit in a TIFF.
+
+    @param z:                   1-based Z index, for the file name
+    @param t:                   1-based T index, for the file name
+    """
+    pages = None
+    if format == 'TIFF':
+        pages = [array_to_image(plane) for plane in data]
+        if any(page is None for page in pages):
+            pages = None
+    extension = IMAGE_FORMATS["TIFF"][0] if pages else "npy"
+    img_name = make_roi_image_name(row_data['roi_id'], row_data['shape_id'],
+                                   "raw", z, t, extension, folder_name)
+    log("Saving raw pixels: %s" % img_name, DEBUG)
+    if pages is None:
+        save_array(data, img_name)
+        return
+    buf = BytesIO()
+    with timings.stage("encode"):
+        pages[0].save(buf, "TIFF", save_all=True, append_images=pages[1:])
+    save_image_data(buf.getvalue(), img_name)
+
+
+def save_rois_raw(conn, image, meta, regions, channels, mask=True,
+                  format="NPY", folder_name=None, stats_channels=None):
+    """
+    Saves the raw pixel values in the region around each tagged shape,
+    read from the pixels store rather than rendered.
+
+    The tiles that shapes on the same plane share are only read once, see
+    SharedTiles. While their pixels are in
+    memory, the shapes are measured for the stats columns.
+
+    @param meta:                ImageMeta of the image
+    @param regions:             List of (row_data, region) from
+                                get_roi_regions()
+    @param channels:            0-based indexes of the channels to save
+    @param mask:                If true, pixels outside rectangles,
+                                ellipses and polygons are set to 0
+    @param stats_channels:      0-based indexes of the channels to measure,
+                                all of which must be saved
+    @return:                    {(shapeId, z, t): CachedStats} for the
+                                shapes with a Z and T, 0-based
+    """
+    measured = {}
+    pixels_type = meta.pixels_type
+    if pixels_type not in PIXEL_TYPES:
+        log("  ** Can't read %s pixels. **" % pixels_type)
+        return measured
+    if stats_channels is None or \
+            not set(stats_channels).issubset(channels):
+        stats_channels = []
+    positions = [channels.index(c) for c in stats_channels]
+    dtype = numpy.dtype(PIXEL_TYPES[pixels_type])
+    default_z = meta.default_z
+    default_t = meta.default_t
+
+    # (z, t) -> [(row_data, region), ...]
+    planes = OrderedDict()
+    for row_data, region in regions:
+        if region_too_large(region):
+            continue
+        # rows use 1-based Z and T, or "" if the shape has none
+        z = row_data['z'] - 1 if row_data['z'] else default_z
+        t = row_data['t'] - 1 if row_data['t'] else default_t
+        planes.setdefault((z, t), []).append((row_data, region))
+
+    store = open_raw_pixels_store(conn, meta.pixels_id, 0)[0]
+    try:
+        tile_size = store.getTileSize()
+        for (z, t), plane_regions in planes.items():
+            # top to bottom, so shared tiles are let go of early
+            plane_regions.sort(key=lambda r: (r[1][1], r[1][0]))
+            shared = SharedTiles([region for _, region in plane_regions],
+                                 tile_size)
+            for row_data, region in plane_regions:
+                roi = numpy.stack([read_tiled_region(store, region, z, c, t,
+                                                     dtype, shared)
+                                   for c in channels])
+                shape_mask = make_shape_mask(row_data, region)
+                if positions and row_data['z'] and row_data['t']:
+                    with timings.stage("measure"):
+                        stats = measure_shape_pixels(
+                            row_data['shape_id'], roi[positions], shape_mask)
+                    if stats is not None:
+                        measured[(row_data['shape_id'], z, t)] = stats
+                if mask and shape_mask is not None:
+                    roi = numpy.where(shape_mask, roi, 0).astype(roi.dtype)
+                save_raw_roi(roi, row_data, z + 1, t + 1, format,
+                             folder_name)
+    finally:
+        store.close()
+    return measured
+
+
 def save_as_ome_tiff(conn, image, folder_name=None):
     """
     Saves the image as an ome.tif in the specified folder
@@ -537,17 +2151,245 @@ def save_as_ome_tiff(conn, image, folder_name=None):
     if folder_name is not None:
         img_name = os.path.join(folder_name, img_name)
     # check we don't overwrite existing file
-    i = 1
-    path_name = img_name[:-(len(extension)+1)]
-    while os.path.exists(img_name):
-        img_name = "%s_(%d).%s" % (path_name, i, extension)
-        i += 1
+    img_name = file_names.unique(img_name, extension)
 
     log("  Saving file as: %s" % img_name)
-    file_size, block_gen = image.exportOmeTiff(bufsize=65536)
-    with open(str(img_name), "wb") as f:
-        for piece in block_gen:
-            f.write(piece)
+    with timings.stage("export_ome_tiff"):
+        export_ome_tiff(conn, image, img_name)
+    archive_file(img_name)
+
+
+class BlockWriter(object):
+    """
+    Appends blocks to a file on a background thread, so that the next block
+    is read from the server while the last one is written. Once each block
+    is written, the checkpoint is saved with the new length of the file.
+    """
+
+    def __init__(self, path, checkpoint, checkpoint_path):
+        """
+        @param checkpoint:  Dict saved as JSON. Its "offset" is the number
+                            of bytes of the file to keep
+        @param checkpoint_path: Where the checkpoint is saved, or None to
+                            not save it
+        """
+        self.checkpoint = checkpoint
+        self.checkpoint_path = checkpoint_path
+        offset = checkpoint["offset"]
+        self.file = open(path, "r+b" if offset else "wb")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.queue = queue.Queue(maxsize=OME_TIFF_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        """Queues a block to be written after the ones already queued."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                if self.error is None:
+                    with timings.stage("write_ome_tiff"):
+                        self.file.write(data)
+                        self.file.flush()
+                    self.checkpoint["offset"] += len(data)
+                    if self.checkpoint_path is not None:
+                        save_checkpoint(self.checkpoint,
+                                        self.checkpoint_path)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Waits for the queued blocks to be written and closes the file."""
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def load_checkpoint(path):
+    """Reads a checkpoint saved by save_checkpoint(), or returns None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint, path):
+    """Saves a checkpoint, replacing the old one in a single step."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def lock_partial_ome_tiff(lock_path):
+    """
+    Takes an exclusive lock on the partial OME-TIFF files of an image, so
+    that only one export at a time writes them.
+
+    @return:            The open lock file, to be closed to release the
+                        lock, or None if another export holds it or locks
+                        aren't supported
+    """
+    if fcntl is None:
+        return None
+    lock_file = open(lock_path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # the file may have been deleted by whoever held the lock
+        if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+            return lock_file
+    except (IOError, OSError):
+        pass
+    lock_file.close()
+    return None
+
+
+def clean_partial_ome_tiffs(max_age=OME_TIFF_PARTIAL_MAX_AGE):
+    """
+    Deletes the partial OME-TIFF files of exports that died and weren't
+    resumed within max_age seconds, unless they are locked.
+    """
+    try:
+        names = os.listdir(OME_TIFF_PARTIAL_PATH)
+    except OSError:
+        return
+    # files of an image all start with its "<image id>_<pixels id>" base
+    by_base = {}
+    for name in names:
+        by_base.setdefault(name.split(".")[0], []).append(
+            os.path.join(OME_TIFF_PARTIAL_PATH, name))
+    now = time.time()
+    for base, paths in by_base.items():
+        try:
+            if now - max(os.path.getmtime(p) for p in paths) < max_age:
+                continue
+        except OSError:
+            continue
+        lock_path = os.path.join(OME_TIFF_PARTIAL_PATH, base + ".lock")
+        lock_file = lock_partial_ome_tiff(lock_path)
+        if lock_file is None:
+            continue
+        try:
+            # the lock file last, while it is still held
+            for path in sorted(paths, key=lambda p: p == lock_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            log("Deleted abandoned partial OME-TIFF export: %s" % base)
+        finally:
+            lock_file.close()
+
+
+def export_ome_tiff(conn, image, path):
+    """
+    Exports the image as an OME-TIFF file.
+
+    The file is read from the server in blocks sized to the measured
+    throughput, and written on a background thread. It is put together in
+    OME_TIFF_PARTIAL_PATH with a checkpoint of how much of it is on disk,
+    so an export that dies partway through carries on from the last block
+    written. The server generates the file again for every export, so what
+    is on disk is only kept if the new file has the same size and starts
+    with the same block.
+
+    The partial files are locked while they are written. If another export
+    of the image holds the lock, the file is put together next to path
+    instead, and not resumed.
+    """
+    try:
+        os.makedirs(OME_TIFF_PARTIAL_PATH)
+    except OSError:
+        pass
+    base = os.path.join(OME_TIFF_PARTIAL_PATH, "%s_%s" % (
+        image.getId(), image.getPixelsId()))
+    lock_file = lock_partial_ome_tiff(base + ".lock")
+    if lock_file is not None:
+        part_path = base + ".ome.tif.part"
+        checkpoint_path = base + ".json"
+    else:
+        log("  Partial export locked by another export, not resuming")
+        part_path = path + ".part"
+        checkpoint_path = None
+    try:
+        export_ome_tiff_part(conn, image, part_path, checkpoint_path)
+        shutil.move(part_path, path)
+        if lock_file is not None:
+            os.remove(checkpoint_path)
+            # while the lock is still held
+            os.remove(base + ".lock")
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+
+def export_ome_tiff_part(conn, image, part_path, checkpoint_path):
+    """
+    Writes the OME-TIFF file of the image to part_path, carrying on from
+    the checkpoint at checkpoint_path if it matches, see export_ome_tiff().
+    """
+    exporter = conn.createExporter()
+    try:
+        exporter.addImage(image.getId())
+        with timings.stage("generate_ome_tiff"):
+            size = exporter.generateTiff()
+        head = exporter.read(0, min(size, OME_TIFF_MIN_BLOCK))
+        checkpoint = {
+            "image_id": image.getId(),
+            "size": size,
+            "head": hashlib.sha1(head).hexdigest(),
+            "offset": 0,
+        }
+        previous = None
+        if checkpoint_path is not None:
+            previous = load_checkpoint(checkpoint_path)
+        if previous is not None and \
+                previous.get("size") == checkpoint["size"] and \
+                previous.get("head") == checkpoint["head"] and \
+                os.path.exists(part_path) and \
+                os.path.getsize(part_path) >= previous["offset"]:
+            checkpoint["offset"] = previous["offset"]
+            log("  Resuming at %d of %d bytes"
+                % (checkpoint["offset"], size))
+        offset = checkpoint["offset"]
+        writer = BlockWriter(part_path, checkpoint, checkpoint_path)
+        try:
+            if offset == 0:
+                writer.write(head)
+                offset = len(head)
+            block_size = OME_TIFF_MIN_BLOCK
+            while offset < size:
+                start = time.time()
+                with timings.stage("read_ome_tiff"):
+                    data = exporter.read(offset,
+                                         min(block_size, size - offset))
+                if not data:
+                    raise IOError("OME-TIFF export ended at %d of %d bytes"
+                                  % (offset, size))
+                writer.write(data)
+                offset += len(data)
+                elapsed = time.time() - start
+                if elapsed < OME_TIFF_BLOCK_SECONDS / 2:
+                    block_size = min(block_size * 2, OME_TIFF_MAX_BLOCK)
+                elif elapsed > OME_TIFF_BLOCK_SECONDS * 2:
+                    block_size = max(block_size // 2, OME_TIFF_MIN_BLOCK)
+        finally:
+            writer.close()
+    finally:
+        exporter.close()
 
 
 def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
@@ -609,22 +2451,24 @@ def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
         else:
             # if we're rendering 'merged' image - don't want grey!
             g_scale = False
+        # set once for all the planes rendered with this channel
+        render_key = set_rendering_channel(image, c, g_scale)
         for t in t_indexes:
             if z_range is None:
                 default_z = image.getDefaultZ()+1
                 save_plane(image, format, c_name, (default_z,), project_z, t,
-                           c, g_scale, zoom_percent, folder_name)
+                           zoom_percent, folder_name, render_key)
             elif project_z:
-                save_plane(image, format, c_name, z_range, project_z, t, c,
-                           g_scale, zoom_percent, folder_name)
+                save_plane(image, format, c_name, z_range, project_z, t,
+                           zoom_percent, folder_name, render_key)
             else:
                 if len(z_range) > 1:
                     for z in range(z_range[0], z_range[1]):
                         save_plane(image, format, c_name, (z,), project_z, t,
-                                   c, g_scale, zoom_percent, folder_name)
+                                   zoom_percent, folder_name, render_key)
                 else:
                     save_plane(image, format, c_name, z_range, project_z, t,
-                               c, g_scale, zoom_percent, folder_name)
+                               zoom_percent, folder_name, render_key)
 
 
 def get_z_range(size_z, script_params):
@@ -685,45 +2529,249 @@ def set_zoom_percent(conn, script_params):
     return 100
 
 
-def get_tags(export_data):
-    return ("test",)
+def compile_tag_pattern(tag_delimiter):
+    """
+    Builds the pattern that finds tags in shape text. Each tag starts at a
+    delimiter and runs up to the next one or the end of the text.
+    """
+    delimiter = re.escape(tag_delimiter)
+    return re.compile(r'%s([^%s]+)' % (delimiter, delimiter))
 
 
-def write_log_file(conn, log_strings, export_dir, log_file_name):
-    log_path = os.path.join(export_dir, log_file_name)
-    with open(log_path, 'w') as log_file:
-        for s in log_strings:
-            log_file.write(s)
-            log_file.write("\n")
-    return conn.createFileAnnfromLocalFile(log_path, mimetype="text")
+def get_tags(text, tag_re, tags_filter=None):
+    """
+    Returns the tags in a shape's text, E.g. "#tumor #necrosis" ->
+    ["tumor", "necrosis"]. Anything before the first delimiter is not a tag.
+
+    @param tag_re:          Compiled pattern from compile_tag_pattern()
+    @param tags_filter:     Set of tags to keep. If None, keep all tags
+    """
+    if not text:
+        return []
+    tags = []
+    for tag in tag_re.findall(text):
+        tag = tag.strip()
+        if tag and tag not in tags and \
+                (tags_filter is None or tag in tags_filter):
+            tags.append(tag)
+    return tags
+
+
+def write_tag_index(tag_index, file_name):
+    """Writes the tag index to a CSV file with one row per tagged shape."""
+    log("Writing tag index '%s'" % file_name)
+    with open(file_name, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file, lineterminator="\n")
+        csv_writer.writerow(["tag", "image_id", "roi_id", "shape_id"])
+        for tag in sorted(tag_index):
+            log("  %s: %d shapes" % (tag, len(tag_index[tag])))
+            for ids in tag_index[tag]:
+                csv_writer.writerow((tag,) + ids)
+
+
+def get_export_settings(script_params):
+    """The params that change the exported files, see MANIFEST_SETTINGS."""
+    return dict((key, script_params.get(key)) for key in MANIFEST_SETTINGS)
+
+
+def write_manifest(metas, tagged_shapes, settings, file_name):
+    """
+    Writes what was exported, so that the next export can be incremental.
+    Must be called once all of the exported files are in the archive.
 
-def get_units_and_symbol(images):
+    @param metas:           ImageMeta of the exported images
+    @param tagged_shapes:   {image_id: [TaggedShape, ...]}
+    @param settings:        From get_export_settings()
+    """
+    log("Writing manifest '%s'" % file_name)
+    archive.flush()
+    shapes = {}
+    for meta in metas:
+        for shape in tagged_shapes[meta.image_id]:
+            shapes[shape.shape_id] = {
+                "image_id": meta.image_id,
+                "image_name": meta.name,
+                "roi_id": shape.roi_id,
+                "version": shape.version,
+                "tags": shape.tags,
+            }
+    files = {}
+    for name, (image_id, shape_id) in archive.owners.items():
+        files[name] = {"image_id": image_id, "shape_id": shape_id,
+                       "checksum": archive.checksums.get(name)}
+    with open(file_name, 'w') as f:
+        json.dump({"settings": settings, "shapes": shapes, "files": files},
+                  f, sort_keys=True)
+
+
+class PreviousExport(object):
+    """
+    The files, index rows and manifest of an earlier export, read from its
+    zip file. Shapes that haven't changed since then are copied from it
+    rather than measured and rendered again.
+
+    Changes to rendering settings aren't tracked, so turn Incremental off
+    to export again after changing them.
+    """
+
+    def __init__(self, path):
+        self.zip_file = zipfile.ZipFile(path)
+        manifest = json.loads(self.zip_file.read(MANIFEST_FILE_NAME)
+                              .decode('utf8'))
+        self.settings = manifest["settings"]
+        # JSON keys are strings
+        self.shapes = dict((int(shape_id), shape) for shape_id, shape
+                           in manifest["shapes"].items())
+        self.files = manifest["files"]
+        # shape_id -> [name, ...], image_id -> [name, ...] for files of a
+        # whole image
+        self.shape_files = {}
+        self.image_files = {}
+        for name, owner in self.files.items():
+            if owner["shape_id"] is not None:
+                self.shape_files.setdefault(owner["shape_id"], []).append(name)
+            else:
+                self.image_files.setdefault(owner["image_id"], []).append(name)
+        # shape_id -> [row, ...]
+        self.rows = {}
+        with self.zip_file.open(INDEX_FILE_NAME) as f:
+            reader = csv.reader(TextIOWrapper(f, encoding='utf8', newline=''))
+            self.header = next(reader)
+            shape_id_index = COLUMN_NAMES.index("shape_id")
+            for row in reader:
+                self.rows.setdefault(int(row[shape_id_index]), []).append(row)
+
+    def has_files(self, names):
+        """Checks that the files are in the zip file and unchanged."""
+        for name in names:
+            try:
+                info = self.zip_file.getinfo(name)
+            except KeyError:
+                return False
+            if info.CRC != self.files[name]["checksum"]:
+                return False
+        return True
+
+    def unchanged(self, meta, shape):
+        """
+        Checks whether a TaggedShape of the image, with ImageMeta meta, can
+        be copied from the earlier export.
+        """
+        previous = self.shapes.get(shape.shape_id)
+        return (previous is not None and
+                previous["image_id"] == meta.image_id and
+                previous["image_name"] == meta.name and
+                previous["version"] == shape.version and
+                previous["tags"] == shape.tags and
+                shape.shape_id in self.rows and
+                self.has_files(self.shape_files.get(shape.shape_id, [])))
+
+    def copy_files(self, names):
+        """Adds files from the earlier export to the archive."""
+        for name in names:
+            archive.add_bytes(name, self.zip_file.read(name))
+
+    def close(self):
+        self.zip_file.close()
+
+
+def load_previous_export(conn, parent, export_file, settings):
+    """
+    Downloads the last zip file exported to the same file name on parent.
+
+    @return:            A PreviousExport or None if there is no previous
+                        export with the same settings
+    """
+    file_name = os.path.basename(export_file)
+    anns = [ann for ann in parent.listAnnotations(ns=EXPORT_NS)
+            if isinstance(ann._obj, omero.model.FileAnnotationI) and
+            ann.getFile().getName() == file_name]
+    if not anns:
+        log("No previous export of %s found, exporting everything"
+            % file_name)
+        return None
+    ann = max(anns, key=lambda a: a.getId())
+    log("Exporting changes since %s (File Annotation %s)"
+        % (file_name, ann.getId()))
+    path = "previous_%s" % file_name
+    with open(path, 'wb') as f:
+        for chunk in ann.getFileInChunks():
+            f.write(chunk)
+    try:
+        previous = PreviousExport(path)
+    except (KeyError, ValueError, StopIteration, zipfile.BadZipfile) as e:
+        log("  ** Can't read previous export, exporting everything: %s **"
+            % e)
+        return None
+    if previous.settings != settings:
+        log("Export settings have changed, exporting everything")
+        previous.close()
+        return None
+    return previous
+
+
+def write_timings(file_name):
+    """Writes the timings report and logs the time spent in each stage."""
+    report = timings.report()
+    log("Timings:")
+    for name, stage in sorted(report["stages"].items()):
+        log("  %s: %d calls, %.1f s" % (name, stage["calls"],
+                                        stage["seconds"]))
+    for name, count in sorted(report["counters"].items()):
+        log("  %s: %d" % (name, count))
+    with open(file_name, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def open_log_file(script_params):
+    """Starts writing the log to the export folder."""
+    export_log.level = LOG_LEVELS[script_params.get("Log_Level", "DEBUG")]
+    export_dir = script_params["Folder_Name"]
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    export_log.open(os.path.join(export_dir, LOG_FILE_NAME))
+
+
+def write_log_file(conn):
+    """Finishes the log file and creates a file annotation for it."""
+    export_log.close()
+    return conn.createFileAnnfromLocalFile(export_log.path, mimetype="text")
+
+def get_units_and_symbol(metas):
     # Find units for length. If any images have NO pixel size, use 'pixels'
     # since we can't convert
     any_none = False
-    for i in images:
-        if i.getPixelSizeX() is None:
+    for meta in metas:
+        if meta.pixel_size_x is None:
             any_none = True
-    pixel_size_x = images[0].getPixelSizeX(units=True)
-    if any_none:
+    if any_none or not metas:
         return None, None
     else:
+        pixel_size_x = metas[0].pixel_size_x
         return pixel_size_x.getUnit(), pixel_size_x.getSymbol()
 
 
-def image_too_large(pixels):
-    size_x = pixels.getSizeX()
-    size_y = pixels.getSizeY()
-    if size_x*size_y > OMERO_MAX_DOWNLOAD_SIZE:
-        msg = """Can't export image over %s pixels. See Omero server configurat\
-        ion property 'omero.client.download_as.max_size (https://docs.openmicro\
-        scopy.org/omero/5.5.0/sysadmins/config.html#omero-client-download-as-ma\
-        x-size)""" % OMERO_MAX_DOWNLOAD_SIZE
-        log("  ** %s. **" % msg)
-        return [msg]#for consistency
+def open_worker_conn(conn):
+    """
+    Opens another connection joined to the script's session. Worker threads
+    each use their own so that service calls and rendering engines are not
+    shared between threads.
+    """
+    client = conn.c.createClient(secure=True)
+    worker_conn = BlitzGateway(client_obj=client)
+    worker_conn.SERVICE_OPTS.setOmeroGroup(-1)
+    return worker_conn
 
 
-def export_images_of_tagged_rois(conn, script_params, objects):
+def export_images_of_tagged_rois(conn, script_params, objects, previous=None):
+    """
+    Exports the tagged ROIs of the images, or of the images in the datasets.
+
+    @param previous:        PreviousExport to copy unchanged shapes from, for
+                            an incremental export
+    @return:                Tuple of (generator of index tables, tag index,
+                            units symbol, message)
+    """
     # for params with default values, we can get the value directly
     split_cs = script_params["Export_Individual_Channels"]
     merged_cs = script_params["Export_Merged_Image"]
@@ -732,11 +2780,27 @@ def export_images_of_tagged_rois(conn, script_params, objects):
     folder_name = script_params["Folder_Name"]
     folder_name = os.path.basename(folder_name)
     format = script_params["Format"]
+    crop_rois = script_params.get("Crop_To_ROIs", True) and \
+        format != 'OME-TIFF'
+    resolution_level = script_params.get("Resolution_Level", 0)
+    raw_pixels = script_params.get("Raw_Pixels", False) and \
+        format != 'OME-TIFF'
+    mask_raw_pixels = script_params.get("Mask_Raw_Pixels", True)
+    tag_delimiter = script_params.get("Tag_Delimiter", "#")
+    tags_filter = script_params.get("Tags_Filter")
+    tags_filter = set(tags_filter) if tags_filter else None
     project_z = False
     message = []
-    if (not split_cs) and (not merged_cs):
+    if not tag_delimiter:
+        # there would be nothing to find the tags by
+        raise ValueError("Tag_Delimiter can't be empty, enter the character"
+                         " that starts each tag, E.g. '#'")
+    if (not split_cs) and (not merged_cs) and not raw_pixels:
+        # raw pixels are saved whatever the channel options
         log("Not chosen to save Individual Channels OR Merged Image")
-        return
+        message.append("Not chosen to save Individual Channels OR Merged"
+                       " Image")
+        return [], {}, None, '\n'.join(message)
 
     # check if we have these params
     channel_names = []
@@ -748,16 +2812,37 @@ def export_images_of_tagged_rois(conn, script_params, objects):
     parent = objects[0] #NMS: Why first index? Has to do with data model?
 
     if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
+        # only the IDs for now, the images are loaded as they are exported
+        with timings.stage("load_images"):
+            image_ids = get_dataset_image_ids(
+                conn, [ds.getId() for ds in objects])
+        if not image_ids:
             message.append("No image found in dataset(s)")
-            return None, '\n'.join(message)
+            return [], {}, None, '\n'.join(message)
     else:
-        images = objects
-
-    log("Processing %s images" % len(images))
+        image_ids = []
+        seen = set()
+        for img in objects:
+            if img.getId() not in seen:
+                seen.add(img.getId())
+                image_ids.append(img.getId())
+
+    log("Processing %s images" % len(image_ids))
+
+    # Find the tagged shapes up front so that images without any are
+    # skipped before their pixels or stats are touched
+    tag_re = compile_tag_pattern(tag_delimiter)
+    with timings.stage("find_tagged_shapes"):
+        tagged_shapes, tag_index = build_tag_index(
+            find_tagged_shapes(conn, image_ids, tag_delimiter), tag_re,
+            tags_filter)
+    image_ids = [i for i in image_ids if i in tagged_shapes]
+    log("%s images have tagged shapes" % len(image_ids))
+    # everything about the pixels and channels of the images, in bulk
+    metas = load_image_meta(conn, image_ids)
+    image_ids = [i for i in image_ids if i in metas]
+    length_units, units_symbol = get_units_and_symbol(
+        [metas[i] for i in image_ids])
 
     # somewhere to put images
     curr_dir = os.getcwd()
@@ -766,71 +2851,292 @@ def export_images_of_tagged_rois(conn, script_params, objects):
         os.mkdir(exp_dir)
     except OSError:
         pass
-
-    ids = []
-    # do the saving to disk
-    roi_export_data = []
-    length_units, units_symbol = get_units_and_symbol(images)
-    for img in images:
-        log("Processing image: ID %s: %s" % (img.id, img.getName()))
+    file_names.reset(folder_name)
+
+    workers = max(1, script_params.get("Workers", DEFAULT_WORKERS))
+    worker_data = threading.local()
+    worker_conns = []
+    worker_conns_lock = threading.Lock()
+
+    def get_worker_conn():
+        """Each worker thread uses its own connection to the session."""
+        if workers == 1:
+            return conn
+        if not hasattr(worker_data, 'conn'):
+            worker_data.conn = open_worker_conn(conn)
+            with worker_conns_lock:
+                worker_conns.append(worker_data.conn)
+        return worker_data.conn
+
+    def export_image(img, shapes, save_pixels):
+        """Gets the index data for one image and saves its ROIs."""
+        meta = metas[img.getId()]
+        # img was loaded with this worker's connection
+        worker_conn = get_worker_conn()
+        log("Processing image: ID %s: %s" % (meta.image_id, meta.name))
+        measure = None
+        if raw_pixels and save_pixels:
+            # read from the pixels store, no rendering engine needed
+            channels = list(range(meta.size_c))
+
+            def measure(regions, ch_indexes):
+                """Saves the raw pixels of the shapes and measures them."""
+                log("  Reading raw pixels of %d ROIs" % len(regions))
+                return save_rois_raw(worker_conn, img, meta, regions,
+                                     channels, mask_raw_pixels, format=format,
+                                     folder_name=folder_name,
+                                     stats_channels=ch_indexes)
         #NMS: Check for tags in ROI comments
-        tags = get_tags(img)
-        if len(tags) < 1:
-            continue
-        for tag in tags:
-            row_to_export = get_export_data(conn, script_params, img, tag, length_units)
-            roi_export_data.extend(row_to_export)
-        pixels = img.getPrimaryPixels()
-        if image_too_large(pixels):
-            continue
-        if (pixels.getId() in ids):
+        image_rows = get_export_data(worker_conn, script_params, meta,
+                                     shapes, length_units, measure)
+        if len(image_rows) == 0:
+            log("  No tagged ROIs")
+            return image_rows
+        if not save_pixels or raw_pixels:
+            # raw pixels are saved while the shapes are measured
+            return image_rows
+        with timings.stage("start_rendering_engine"):
+            # one engine for the image, from the big image check through
+            # every channel, Z and T
+            attached = format == 'OME-TIFF' or \
+                img._prepareRenderingEngine()
+        if not attached:
+            log("  ** Failed to start rendering engine. **")
+            return image_rows
+        try:
+            if requires_tiled_export(img, meta):
+                # Big images can't be rendered or exported whole, so only the
+                # tagged regions are read, tile by tile
+                log("Exporting ROIs from big image as tiles: %s" % meta.name)
+                if format == 'OME-TIFF':
+                    log("  ** Can't export a 'Big' image to OME-TIFF, "
+                        "saving ROIs as TIFF. **")
+                regions = get_roi_regions(image_rows, meta.size_x, meta.size_y)
+                log("  Reading %d ROIs" % len(regions))
+                save_rois_tiled(worker_conn, img, meta, regions, split_cs,
+                                merged_cs, channel_names, resolution_level,
+                                format=('TIFF' if format == 'OME-TIFF'
+                                        else format),
+                                folder_name=folder_name)
+            elif format == 'OME-TIFF':
+                save_as_ome_tiff(worker_conn, img, folder_name)
+            else:
+                log("Exporting image as %s: %s" % (format, meta.name))
+                log("\n----------- Saving planes from image: '%s' ------------"
+                    % meta.name)
+                size_c = meta.size_c
+                z_range = (1,)
+                t_range = (1,)
+                log("Using:")
+                log("  Z-index: %d" % z_range[0])
+                log("  T-index: %d" % t_range[0])
+                log("  Format: %s" % format)
+                log("  Image Zoom: %s" % zoom_percent)
+                log("  Greyscale: %s" % greyscale)
+                log("  Crop to ROIs: %s" % crop_rois)
+                log("Channel Rendering Settings:")
+                for ch in img.getChannels():
+                    log("  %s: %d-%d"
+                        % (ch.getLabel(), ch.getWindowStart(),
+                           ch.getWindowEnd()))
+
+                if crop_rois:
+                    regions = get_roi_regions(image_rows, meta.size_x,
+                                              meta.size_y)
+                    log("  Cropping %d ROIs" % len(regions))
+                    save_rois_for_image(img, regions, size_c, split_cs,
+                                        merged_cs, channel_names, greyscale,
+                                        zoom_percent, format=format,
+                                        folder_name=folder_name)
+                else:
+                    save_planes_for_image(worker_conn, img, size_c, split_cs,
+                                          merged_cs, channel_names, z_range,
+                                          t_range, greyscale, zoom_percent,
+                                          project_z=project_z, format=format,
+                                          folder_name=folder_name)
+        finally:
+            if img._re is not None:
+                img._re.close()
+                img._re = None
+        return image_rows
+
+    # Images sharing pixels are only saved once. Decide which up front so
+    # the result doesn't depend on the order the workers finish in.
+    ids = set()
+    save_pixels = []
+    for image_id in image_ids:
+        pixels_id = metas[image_id].pixels_id
+        save_pixels.append(pixels_id not in ids)
+        ids.add(pixels_id)
+
+    # For an incremental export, work out up front which shapes and files
+    # can be copied from the previous export. Their names are reserved now
+    # so that the names given to new files don't depend on timing.
+    if previous is not None and \
+            previous.header != get_csv_header(units_symbol):
+        log("Units or columns have changed since the previous export, "
+            "exporting everything")
+        previous = None
+    plans = {}
+    for image_id, save in zip(image_ids, save_pixels):
+        shapes = tagged_shapes[image_id]
+        if previous is None:
+            plans[image_id] = (shapes, [], [], save)
             continue
-        ids.append(pixels.getId())
-
-        if format == 'OME-TIFF':
-            if img._prepareRE().requiresPixelsPyramid():
-                log("  ** Can't export a 'Big' image to OME-TIFF. **")
-                if len(images) == 1:
-                    return None, "Can't export a 'Big' image to %s." % format
-                continue
+        reused = [shape for shape in shapes
+                  if previous.unchanged(metas[image_id], shape)]
+        reused_ids = set(shape.shape_id for shape in reused)
+        changed = [shape for shape in shapes
+                   if shape.shape_id not in reused_ids]
+        files = []
+        for shape in reused:
+            files.extend(previous.shape_files.get(shape.shape_id, []))
+        image_files = previous.image_files.get(image_id, [])
+        if save and image_files and previous.has_files(image_files):
+            # whole planes don't depend on the shapes
+            files.extend(image_files)
+            save = False
+        for name in files:
+            file_names.reserve(os.path.join(folder_name, name))
+        plans[image_id] = (changed, reused, files, save)
+    if previous is not None:
+        log("%d of %d shapes are unchanged since the previous export"
+            % (sum(len(plan[1]) for plan in plans.values()),
+               sum(len(shapes) for shapes in tagged_shapes.values())))
+
+    # the images are loaded by the workers, with their own connections,
+    # unless they already have been
+    preloaded = None
+    if data_type != 'Dataset':
+        preloaded = dict((img.getId(), img) for img in objects)
+
+    def export_tables(img):
+        """
+        Copies an image's unchanged shapes from the previous export and
+        exports the others. Returns a list of RoiTable or CsvRows.
+
+        The rows of both are merged shape by shape, in the order of
+        tagged_shapes, so the index is the same as a full export's.
+        """
+        changed, reused, files, save = plans[img.getId()]
+        export_context.image_id = img.getId()
+        start = time.time()
+        try:
+            if files:
+                previous.copy_files(files)
+            table = None
+            if changed:
+                table = export_image(img, changed, save)
+            if not reused:
+                return [table] if table is not None else []
+            log("Copying %d unchanged shapes of image: ID %s"
+                % (len(reused), img.getId()))
+            # shape_id -> rows, in the column order of COLUMN_NAMES
+            shape_rows = dict((shape.shape_id, previous.rows[shape.shape_id])
+                              for shape in reused)
+            if table is not None:
+                for i in range(len(table)):
+                    row = table.row(i)
+                    shape_rows.setdefault(row["shape_id"], []).append(
+                        [row[name] for name in COLUMN_NAMES])
+            rows = CsvRows()
+            for shape in tagged_shapes[img.getId()]:
+                rows.extend(shape_rows.get(shape.shape_id, []))
+            return [rows]
+        finally:
+            timings.add("export_image", time.time() - start)
+            export_context.image_id = None
+
+    stop = threading.Event()
+
+    def put_result(results, item):
+        """Waits for room on a worker's results queue, unless stopped."""
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def export_worker(worker, results):
+        """
+        Exports every workers-th image, starting with the worker-th, and
+        puts (tables, None) on results for each one in turn, or
+        (None, exception) if the export fails. The images are loaded in
+        batches with the worker's connection.
+        """
+        try:
+            worker_conn = get_worker_conn()
+            ids = image_ids[worker::workers]
+            if worker_conn is conn and preloaded is not None:
+                images = (preloaded[i] for i in ids)
             else:
-                save_as_ome_tiff(conn, img, folder_name)
+                images = iter_images(worker_conn, ids)
+            img = next(images, None)
+            for image_id in ids:
+                if stop.is_set():
+                    return
+                if img is not None and img.getId() == image_id:
+                    tables = export_tables(img)
+                    img = next(images, None)
+                else:
+                    log("  ** Image %s wasn't found. **" % image_id)
+                    tables = []
+                put_result(results, (tables, None))
+        except Exception as e:
+            put_result(results, (None, e))
+
+    def iter_tables():
+        """
+        Exports the images, yielding a RoiTable as each one finishes.
+
+        The tables are yielded in image order. Each worker finishes at most
+        one image ahead of the one being yielded, so no more than about
+        twice as many images as workers are held in memory.
+        """
+        log("Exporting with %d worker(s)" % workers)
+        queues = [queue.Queue(maxsize=1) for _ in range(workers)]
+        threads = [threading.Thread(target=export_worker, args=(i, q))
+                   for i, q in enumerate(queues)]
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for i in range(len(image_ids)):
+                tables, error = queues[i % workers].get()
+                if error is not None:
+                    raise error
+                for image_rows in tables:
+                    yield image_rows
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            for worker_conn in worker_conns:
+                worker_conn.close(hard=False)
+        if archive is not None:
+            saved = archive.names
         else:
-            log("Exporting image as %s: %s" % (format, img.getName()))
-            log("\n----------- Saving planes from image: '%s' ------------"
-                % img.getName())
-            size_c, size_z, size_t = img.getSizeC(), img.getSizeZ(), img.getSizeT()
-            z_range = (1,)
-            t_range = (1,)
-            log("Using:")
-            log("  Z-index: %d" % z_range[0])
-            log("  T-index: %d" % t_range[0])
-            log("  Format: %s" % format)
-            log("  Image Zoom: %s" % zoom_percent)
-            log("  Greyscale: %s" % greyscale)
-            log("Channel Rendering Settings:")
-            for ch in img.getChannels():
-                log("  %s: %d-%d"
-                    % (ch.getLabel(), ch.getWindowStart(), ch.getWindowEnd()))
-
-            try:
-                save_planes_for_image(conn, img, size_c, split_cs, merged_cs,
-                                      channel_names, z_range, t_range,
-                                      greyscale, zoom_percent,
-                                      project_z=project_z, format=format,
-                                      folder_name=folder_name)
-            finally:
-                # Make sure we close Rendering Engine
-                img._re.close()
-    if len(os.listdir(exp_dir)) == 0:
-        return None, "No files exported. See 'info' for more details"
-
-    return roi_export_data, '\n'.join(message)
+            # the index and log files are being written to the same folder
+            saved = [f for f in os.listdir(exp_dir)
+                     if not f.endswith(".csv") and f != LOG_FILE_NAME]
+        if not saved:
+            log("No files exported. See 'info' for more details")
+        if archive is not None:
+            # the checksums of the files are only known once they are in
+            # the archive
+            manifest_path = os.path.join(folder_name, MANIFEST_FILE_NAME)
+            write_manifest([metas[i] for i in image_ids], tagged_shapes,
+                           get_export_settings(script_params), manifest_path)
+            archive_file(manifest_path)
+
+    return iter_tables(), tag_index, units_symbol, '\n'.join(message)
 
 
 def get_client():
     data_types = [rstring('Dataset'), rstring('Image')]
     formats = [rstring('JPEG'), rstring('PNG'), rstring('TIFF'), rstring('OME-TIFF')]
+    log_levels = [rstring(level) for level in sorted(LOG_LEVELS)]
     return scripts.client(
         'extract_tagged_rois.py',
         """Extract ROIs annotated with a user-selectable character. The text   \
@@ -870,20 +3176,93 @@ def get_client():
             description="Save merged image, using current rendering settings",
             default=True),
 
+        scripts.Bool(
+            "Crop_To_ROIs", grouping="7",
+            description="Save only the bounding box of each tagged shape,"
+                        " one file per ROI, instead of the whole plane",
+            default=True),
+
+        scripts.Int(
+            "Resolution_Level", grouping="7.1",
+            description="Pyramid level to read ROIs of big (tiled) images"
+                        " from. 0 is full resolution", default=0, min=0),
+
+        scripts.Bool(
+            "Raw_Pixels", grouping="7.2",
+            description="Save the raw pixel values around each tagged shape"
+                        " instead of rendering it, as a NumPy .npy array of"
+                        " (channel, y, x), or a multi-page TIFF if Format is"
+                        " TIFF", default=False),
+
+        scripts.Bool(
+            "Mask_Raw_Pixels", grouping="7.3",
+            description="Set the raw pixels outside rectangles, ellipses"
+                        " and polygons to 0", default=True),
+
         scripts.String(
             "Format", grouping="8",
             description="Format to save image", values=formats,
             default='JPEG'),
 
+        scripts.Bool(
+            "Render_To_Archive", grouping="8.1",
+            description="Write rendered images straight into the zip file"
+                        " instead of saving them to disk first",
+            default=True),
+
         scripts.String(
             "Folder_Name", grouping="9",
             description="Name of folder (and zip file) to store images and index file",
             default='Tagged_ROI_Export'),
 
+        scripts.String(
+            "Log_Level", grouping="9.1",
+            description="INFO leaves out the messages about each shape and"
+                        " file from the log", values=log_levels,
+            default='DEBUG'),
+
         scripts.String(
             "Tag_Delimiter", grouping="10", description="Tag delimiter character that indicates the beginning of each tag. All other characters are assumed to be part of a tag.",
             default="#"),
 
+        scripts.List(
+            "Tags_Filter", grouping="10.1",
+            description="Only export shapes with one of these tags (without"
+                        " the delimiter). Leave empty to export all tags"
+        ).ofType(rstring("")),
+
+        scripts.Bool(
+            "Incremental", grouping="13",
+            description="Only export shapes that are new or have changed"
+                        " since the last export to the same Folder_Name,"
+                        " and copy the rest from its zip file",
+            default=False),
+
+        scripts.Int(
+            "Stats_Cache_Size", grouping="11.1",
+            description="Maximum number of shape stats kept on the server"
+                        " between runs, so unchanged shapes aren't measured"
+                        " again. 0 (the default) turns the cache off",
+            default=STATS_CACHE_SIZE, min=0),
+
+        scripts.Int(
+            "Render_Cache_MB", grouping="8.2",
+            description="Size of the cache of rendered ROIs kept on the"
+                        " server, so exporting again in another format"
+                        " doesn't render them again. 0 (the default) turns"
+                        " it off",
+            default=RENDER_CACHE_MB, min=0),
+
+        scripts.Int(
+            "Workers", grouping="12",
+            description="Number of images to export at the same time",
+            default=DEFAULT_WORKERS, min=1, max=16),
+
+        scripts.Int(
+            "Stats_Batch_Size", grouping="11",
+            description="Maximum number of shapes measured in a single call"
+                        " to the ROI service", default=STATS_BATCH_SIZE, min=1),
+
         version="4.3.0",
         authors=["William Moore", "OME Team", "Nima Seyedtalebi"],
         institutions=["University of Dundee", "University of Kentucky"],
@@ -892,47 +3271,89 @@ def get_client():
 
 
 def run_script():
+    global OMERO_MAX_DOWNLOAD_SIZE, archive, stats_cache, render_cache
     client = get_client()
     try:
         start_time = datetime.now()
         script_params = {}
         conn = BlitzGateway(client_obj=client)
         script_params = client.getInputs(unwrap=True)
+        open_log_file(script_params)
         OMERO_MAX_DOWNLOAD_SIZE = int(conn.getDownloadAsMaxSizeSetting())
         for key, value in script_params.items():
             log("%s:%s" % (key, value))
+        stats_cache = open_stats_cache(script_params)
+        render_cache = open_render_cache(script_params)
+        if script_params.get("Format") == 'OME-TIFF':
+            clean_partial_ome_tiffs()
 
         # Get the images or datasets
         objects, getobj_message = script_utils.get_objects(conn, script_params)
         log("Message from get_objects(): %s" % getobj_message)
         parent = objects[0]
-        roi_export, export_msg = export_images_of_tagged_rois(conn, script_params, objects)
-        units, units_symbol = get_units_and_symbol(objects)
-        # Write index data
-        index_data_path = os.path.join(script_params.get("Folder_Name"), "roi_index_data.csv")
-        csv_file_ann = write_csv(conn, roi_export, units_symbol, index_data_path)
-        # zip everything up
+        # Files are zipped up as they are saved
         export_file = "%s.zip" % script_params["Folder_Name"]
+        previous = None
+        if script_params.get("Incremental", False):
+            # before the new zip file is created with the same name
+            previous = load_previous_export(
+                conn, parent, export_file, get_export_settings(script_params))
+        archive = ZipPackager(export_file,
+                              script_params.get("Render_To_Archive", True))
+        roi_export, tag_index, units_symbol, export_msg = \
+            export_images_of_tagged_rois(conn, script_params, objects,
+                                         previous)
+        # Write index data
+        index_data_path = os.path.join(script_params.get("Folder_Name"),
+                                       INDEX_FILE_NAME)
+        # Images are exported while the index rows are being written
+        csv_file_ann, row_count = write_csv(conn, roi_export, units_symbol,
+                                            index_data_path)
+        archive_file(index_data_path)
+        tag_index_path = os.path.join(script_params.get("Folder_Name"),
+                                      "tag_index.csv")
+        write_tag_index(tag_index, tag_index_path)
+        archive_file(tag_index_path)
+        timings_path = os.path.join(script_params.get("Folder_Name"),
+                                    TIMINGS_FILE_NAME)
+        # so that compressing the other files is counted
+        archive.flush()
+        write_timings(timings_path)
+        archive_file(timings_path)
         #message.append()
-        compress_msg = compress(export_file, script_params["Folder_Name"])
+        archive.close()
+        archive = None
+        if previous is not None:
+            previous.close()
         mimetype = 'application/zip'
         output_display_name = "Batch export zip"
-        namespace = NSCREATED + "/opt/scripts/extract_tagged_rois"
-        zip_file_ann, ann_message = script_utils.create_link_file_annotation(
-            conn, export_file, parent, output=output_display_name,
-            namespace=namespace, mimetype=mimetype)
+        namespace = EXPORT_NS
+        with timings.stage("upload"):
+            zip_file_ann, ann_message = \
+                script_utils.create_link_file_annotation(
+                    conn, export_file, parent, output=output_display_name,
+                    namespace=namespace, mimetype=mimetype)
         #message.append(ann_message)
         stop_time = datetime.now()
         log("Duration: %s" % str(stop_time-start_time))
-        message = "Exported {} of the {} images in the set ".format(len(objects), len(roi_export))
-        #client.setOutput("Message", rstring(message))
-        client.setOutput("Mesage", rstring(message))
+        message = "Exported {} of the {} images in the set ".format(len(objects), row_count)
+        client.setOutput("Message", rstring(message))
         if zip_file_ann is not None:
             client.setOutput("Export_File", robject(zip_file_ann._obj))
-        log_file_ann = write_log_file(conn, log_strings, script_params["Folder_Name"],
-                                      "Logs.txt")
+        client.setOutput("Timings", rstring(json.dumps(timings.report(),
+                                                       sort_keys=True)))
+        log_file_ann = write_log_file(conn)
         client.setOutput("Logs", robject(log_file_ann._obj))
+    except Exception:
+        # the script's stdout is shown to the user
+        print(export_log.summary())
+        raise
     finally:
+        export_log.close()
+        if stats_cache is not None:
+            stats_cache.close()
+            stats_cache = None
+        render_cache = None
         client.closeSession()
 
 